@@ -2,30 +2,102 @@
 Salt execution module to manage Eclipse Mosquitto installations.
 """
 
-import re
+import copy
+import hashlib
+import json
+import os
+import signal
 from pathlib import Path
 
+import salt.utils.data
 import salt.utils.path
+import salt.utils.url
 from salt.exceptions import CommandExecutionError, SaltInvocationError
 
 # __utils__ dunder is deprecated
 import mosquitto
+import mosquitto_acl
+import mosquitto_config
 
 __virtualname__ = "mosquitto"
 
 MOSQUITTO_DEFAULT_PW_PATH = "/etc/mosquitto/passwd"
+MOSQUITTO_DEFAULT_ACL_PATH = "/etc/mosquitto/acl"
+MOSQUITTO_DEFAULT_CONF_PATH = "/etc/mosquitto/mosquitto.conf"
 
 
 def __virtual__():
     return True
 
 
+def acl_check(
+    topic=None,
+    access="read",
+    username=None,
+    clientid=None,
+    checks=None,
+    acl=None,
+    acl_file=MOSQUITTO_DEFAULT_ACL_PATH,
+):
+    """
+    Check whether a client would be granted access to a topic, following
+    Mosquitto's default ACL semantics, without a running broker.
+    The ACL is compiled into an index once per Salt run.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.acl_check sensors/kitchen/temp username=elliot
+        salt '*' mosquitto.acl_check checks='[[elliot, phone, nabokov/lolita, write]]'
+
+    topic
+        The topic to check. Wildcards are not allowed.
+
+    access
+        The requested access: ``read``, ``write``, ``readwrite`` or ``subscribe``.
+        Defaults to ``read``.
+
+    username
+        The username of the client. Unset for anonymous clients.
+
+    clientid
+        The client ID of the client. Required for patterns that contain ``%c``.
+
+    checks
+        Batch mode. List of (username, clientid, topic, access) tuples or mappings
+        with those keys to check. Overrides the single check parameters.
+
+    acl
+        Mapping in the format of the formula's ``acl`` configuration
+        (``anonymous``, ``user``, ``pattern``) to check against instead of ``acl_file``.
+
+    acl_file
+        Path to the ACL file to check against. Defaults to "/etc/mosquitto/acl".
+
+    Returns a boolean or, in batch mode, a list of booleans in the order of ``checks``.
+    """
+
+    if topic is None and checks is None:
+        raise SaltInvocationError("You need to specify either topic or checks.")
+
+    index = _get_acl_index(acl=acl, acl_file=acl_file)
+
+    try:
+        if checks is None:
+            return index.check(topic, access, username=username, clientid=clientid)
+        return index.check_many([_parse_acl_check(check) for check in checks])
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+
 def add_user(
     username,
     password=None,
     password_hash=None,
     update=False,
     pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    append=False,
 ):
     """
     Add or update a Mosquitto user.
@@ -53,6 +125,14 @@ def add_user(
 
     pw_file
         Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
+
+    append
+        If the user does not exist yet, append it to the password file instead
+        of rewriting the whole file. This leaves the file unsorted, which makes
+        lookups of missing users slower. Run ``mosquitto.compact_pw_file``
+        afterwards to restore the order. Defaults to false.
+
+    Returns whether the backend was modified. Setting an identical hash does not modify it.
     """
 
     if password is None and password_hash is None:
@@ -60,9 +140,9 @@ def add_user(
             "You need to specify either password or password_hash."
         )
 
-    users = list_users(include_pass=True, pw_file=pw_file)
+    exists = user_exists(username, pw_file=pw_file)
 
-    if username in users and not update:
+    if exists and not update:
         raise CommandExecutionError(
             f"User {username} exists. To update the password, set update=True."
         )
@@ -73,12 +153,115 @@ def add_user(
         )
 
     password_hash = password_hash or get_pw_hash(password)
+
+    if append and not exists:
+        with _profile().phase("write"):
+            return mosquitto.append_pw_file(pw_file, username, password_hash)
+
+    users = list_users(include_pass=True, pw_file=pw_file)
     users[username] = password_hash
-    return mosquitto.write_pw_file(pw_file, users)
+    with _profile().phase("write"):
+        return mosquitto.write_pw_file(pw_file, users)
+
+
+def cache_mapdata(tplroot, mapdata):
+    """
+    Remember the rendered ``mapdata`` of a formula for the rest of the current run.
+    ``map.jinja`` calls this after computing it, so the remaining SLS files of the
+    run can skip the parameter file loading, merging and post-processing.
+    The cache is keyed by a fingerprint of the grains, pillar and environments,
+    so it is invalidated if any of these change. Returns true if the mapdata
+    was cached and false if the fingerprint could not be computed.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.cache_mapdata mosquitto '{...}'
+
+    tplroot
+        The name of the formula.
+
+    mapdata
+        The rendered mapdata.
+    """
+
+    fingerprint = _mapdata_fingerprint(tplroot)
+    if fingerprint is None:
+        return False
+    __context__[f"mosquitto.mapdata.{tplroot}"] = (
+        fingerprint,
+        copy.deepcopy(mapdata),
+    )
+    return True
+
+
+def calibrate_hash(
+    target_ms=10,
+    connections=None,
+    cpu_share=0.5,
+    hmac_hash="sha512",
+    keylen=None,
+    persist=False,
+):
+    """
+    Benchmark PBKDF2 on this minion and recommend hashing parameters
+    for a target per-authentication latency and authentication rate.
+    The recommendation can be persisted as a grain, which the formula
+    consumes when ``tuning:hash_calibration`` is enabled.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.calibrate_hash target_ms=5 connections=2000 persist=true
+
+    target_ms
+        Maximum time a single password check should take, in milliseconds.
+        Defaults to 10.
+
+    connections
+        Number of authentications per second the broker should be able to handle,
+        e.g. during a reconnect storm. Optional.
+
+    cpu_share
+        Share of the minion's CPU cores that may be spent on password checks
+        to handle ``connections``. Defaults to 0.5.
+
+    hmac_hash
+        Hashing algorithm for PBKDF2. Mosquitto only supports sha512. Defaults to sha512.
+
+    keylen
+        Byte count of the resulting hash. Defaults to the digest size
+        of ``hmac_hash``, longer keys multiply the cost.
+
+    persist
+        Save the recommendation in the ``mosquitto_hash_calibration`` grain.
+        Defaults to false.
+    """
+
+    try:
+        res = mosquitto.calibrate_pbkdf2(
+            target_ms=target_ms,
+            connections=connections,
+            hmac_hash=hmac_hash,
+            keylen=keylen,
+            cpu_share=cpu_share,
+        )
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+    if persist:
+        __salt__["grains.setval"]("mosquitto_hash_calibration", res)
+    return res
 
 
 def check_password(
-    password, username=None, pw_hash=None, pw_file=MOSQUITTO_DEFAULT_PW_PATH
+    password,
+    username=None,
+    pw_hash=None,
+    pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    cache=True,
 ):
     """
     Check a Mosquitto password.
@@ -100,6 +283,13 @@ def check_password(
 
     pw_file
         Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
+
+    cache
+        Consult the verified password cache in the minion cachedir before
+        running the key derivation function and record successful verifications there.
+        Defaults to true. Can be disabled globally by setting ``mosquitto.verify_cache: false``
+        in the minion configuration, its size is controlled by ``mosquitto.verify_cache_size``
+        (defaults to 65536 entries).
     """
 
     if username is None and pw_hash is None:
@@ -108,12 +298,232 @@ def check_password(
         )
 
     if username is not None:
-        users = list_users(include_pass=True, pw_file=pw_file)
-        if username not in users:
+        with _profile().phase("read"):
+            pw_hash = mosquitto.read_pw_entry(pw_file, username)
+        if pw_hash is None:
             raise CommandExecutionError(f"User {username} does not exist.")
-        pw_hash = users[username]
 
-    return mosquitto.MosquittoPassword.from_string(pw_hash).check_password(password)
+    with _profile().phase("verify"):
+        pw = mosquitto.MosquittoPassword.from_string(pw_hash)
+        verify_cache = mosquitto.verified_password_cache(__context__, __opts__)
+
+        if not cache or verify_cache is None:
+            return pw.check_password(password)
+        return verify_cache.check(
+            pw_hash, password, lambda: pw.check_password(password)
+        )
+
+
+def check_passwords(pairs, workers=None, processes=False, cache=True):
+    """
+    Check many Mosquitto passwords at once. The hashes are computed
+    on a pool of workers, which scales with the number of CPU cores.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.check_passwords '[[hunter1, $7$101$...], [hunter2, $7$101$...]]'
+
+    pairs
+        List of (password, pw_hash) pairs to check.
+
+    workers
+        Number of parallel workers. Defaults to the number of CPU cores.
+
+    processes
+        Use a process pool instead of a thread pool. Defaults to false.
+
+    cache
+        Consult the verified password cache before hashing and record successful
+        verifications there. Defaults to true. See ``check_password``.
+
+    Returns a list of booleans in the order of ``pairs``.
+    """
+
+    verify_cache = None
+    if cache:
+        verify_cache = mosquitto.verified_password_cache(__context__, __opts__)
+
+    try:
+        with _profile().phase("verify", calls=len(pairs)):
+            return mosquitto.check_passwords(
+                mosquitto.MosquittoPassword,
+                [tuple(pair) for pair in pairs],
+                workers=workers,
+                processes=processes,
+                verify_cache=verify_cache,
+            )
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+
+def compile_acl(acl=None, acl_file=MOSQUITTO_DEFAULT_ACL_PATH):
+    """
+    Normalize an ACL into the smallest equivalent one. Permissions of the same
+    topic are merged, rules that are covered by wildcard or deny rules
+    of the same list and deny rules without effect are dropped. Deny rules
+    of users and anonymous clients that restrict pattern rules are kept
+    and reported as effective.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.compile_acl
+        salt '*' mosquitto.compile_acl acl="$(salt-call --out=json pillar.get mosquitto:acl)"
+
+    acl
+        Mapping in the format of the formula's ``acl`` configuration
+        (``anonymous``, ``user``, ``pattern``) to compile instead of ``acl_file``.
+
+    acl_file
+        Path to the ACL file to compile. Defaults to "/etc/mosquitto/acl".
+
+    Returns a mapping with the compiled ACL in the format of the formula's
+    ``acl`` configuration (``acl``), the ``dropped`` and ``effective`` rules
+    and the number of ``rules`` before and after compilation.
+    """
+
+    if acl is None:
+        try:
+            acl = mosquitto_acl.parse_acl(Path(acl_file).read_text())
+        except FileNotFoundError:
+            raise CommandExecutionError(f"ACL file {acl_file} does not exist.")
+        except ValueError as e:
+            raise CommandExecutionError(f"Could not parse {acl_file}: {e}")
+
+    try:
+        compiled, report = mosquitto_acl.compile_acl(acl)
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+    return {
+        "acl": compiled,
+        "dropped": report["dropped"],
+        "effective": report["effective"],
+        "rules": {
+            "before": mosquitto_acl.count_rules(acl),
+            "after": mosquitto_acl.count_rules(compiled),
+        },
+    }
+
+
+def compact_pw_file(pw_file=MOSQUITTO_DEFAULT_PW_PATH):
+    """
+    Rewrite the password file sorted by username. This is only necessary
+    after adding users with ``append=True``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.compact_pw_file
+
+    pw_file
+        Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
+
+    Returns whether the file was changed.
+    """
+
+    with _profile().phase("write"):
+        return mosquitto.compact_pw_file(pw_file)
+
+
+def config_snapshot(conf_file=MOSQUITTO_DEFAULT_CONF_PATH, update=False):
+    """
+    Return the snapshot of the configuration the broker was last
+    (re)started or reloaded with, as recorded in the minion cachedir.
+    Returns None if there is no snapshot.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.config_snapshot /opt/containers/mosquitto/config/mosquitto.conf
+
+    conf_file
+        Path to the configuration file. Defaults to "/etc/mosquitto/mosquitto.conf".
+
+    update
+        Record the current contents of ``conf_file`` as the snapshot
+        and return it. Defaults to false.
+    """
+
+    path = Path(
+        __opts__["cachedir"],
+        "mosquitto",
+        "config_snapshots",
+        hashlib.sha256(os.path.abspath(conf_file).encode()).hexdigest()[:16] + ".json",
+    )
+
+    if update:
+        model = parse_config(conf_file)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(model, sort_keys=True))
+        return model
+
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return None
+
+
+def diff_config(old, new=MOSQUITTO_DEFAULT_CONF_PATH):
+    """
+    Compare two Mosquitto configurations semantically, ignoring comments,
+    whitespace and the order of lines, and classify the changes by the action
+    that is needed to apply them: ``none``, ``reload`` (SIGHUP) or ``restart``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.diff_config /etc/mosquitto/mosquitto.conf.old
+
+    old
+        Path to the old configuration file or a model returned by ``parse_config``.
+
+    new
+        Path to the new configuration file or a model returned by ``parse_config``.
+        Defaults to "/etc/mosquitto/mosquitto.conf".
+
+    Returns a mapping with the ``action`` and a list of ``changes``.
+    """
+
+    if isinstance(old, str):
+        old = parse_config(old)
+    if isinstance(new, str):
+        new = parse_config(new)
+
+    changes, action = mosquitto_config.diff_config(old, new)
+    return {"action": action, "changes": changes}
+
+
+def get_cached_mapdata(tplroot):
+    """
+    Return a copy of the ``mapdata`` of a formula rendered earlier in the current run
+    or None if there is none or the grains, pillar or environments changed.
+    See ``cache_mapdata``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.get_cached_mapdata mosquitto
+
+    tplroot
+        The name of the formula.
+    """
+
+    cached = __context__.get(f"mosquitto.mapdata.{tplroot}")
+    if cached is None:
+        return None
+    fingerprint = _mapdata_fingerprint(tplroot)
+    if fingerprint is None or cached[0] != fingerprint:
+        return None
+    # SLS files may modify their mapdata
+    return copy.deepcopy(cached[1])
 
 
 def get_pw_hash(password, pbkdf2=True, iterations=101):
@@ -138,20 +548,142 @@ def get_pw_hash(password, pbkdf2=True, iterations=101):
     """
 
     try:
-        pw = mosquitto.MosquittoPassword.from_password(
-            password,
-            algo="pbkdf2" if pbkdf2 else "sha512",
-            iterations=iterations,
-        )
+        with _profile().phase("hash"):
+            return mosquitto.MosquittoPassword.from_password(
+                password,
+                algo="pbkdf2" if pbkdf2 else "sha512",
+                iterations=iterations,
+            ).to_string()
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+
+def get_pw_hashes(passwords, pbkdf2=True, iterations=101, workers=None, processes=False):
+    """
+    Get many password hashes suitable for Mosquitto at once. The hashes are
+    computed on a pool of workers, which scales with the number of CPU cores.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.get_pw_hashes '[hunter1, hunter2]'
+
+    passwords
+        List of passwords to hash.
+
+    pbkdf2
+        Whether to use pbkdf2_sha512 hashing algorithm. For versions 1.6 and below, this should be false.
+        Defaults to true.
+
+    iterations
+        If pbkdf2 is true, number of hashing iterations. Defaults to 101 (mosquitto default).
+
+    workers
+        Number of parallel workers. Defaults to the number of CPU cores.
+
+    processes
+        Use a process pool instead of a thread pool. Defaults to false.
+
+    Returns a list of hashes in the order of ``passwords``.
+    """
+
+    try:
+        with _profile().phase("hash", calls=len(passwords)):
+            return mosquitto.get_pw_hashes(
+                mosquitto.MosquittoPassword,
+                passwords,
+                workers=workers,
+                processes=processes,
+                algo="pbkdf2" if pbkdf2 else "sha512",
+                iterations=iterations,
+            )
     except ValueError as e:
         raise CommandExecutionError(str(e))
 
-    return pw.to_string()
+
+def get_stored_hash(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
+    """
+    Return the stored password hash of a single user or None if the user
+    does not exist. This is a point lookup, the backend is not listed.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.get_stored_hash foo
+
+    username
+        The user's username.
+
+    pw_file
+        Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
+    """
+
+    with _profile().phase("read"):
+        return mosquitto.read_pw_entry(pw_file, username)
 
 
-def list_users(include_pass=False, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
+def iter_users(
+    include_pass=False,
+    pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    prefix=None,
+    limit=None,
+    offset=0,
+    chunk_size=1000,
+):
+    """
+    Stream Mosquitto users in chunks. The password file is read line by line
+    instead of being loaded as a whole. Only the read side is chunked though:
+    When called via the CLI, Salt collects all chunks into the job return,
+    so memory usage still grows with the number of users. Export large
+    files page by page with ``limit``/``offset`` instead.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.iter_users prefix=device_ limit=100
+        salt '*' mosquitto.iter_users limit=10000 offset=20000
+
+    include_pass
+        Whether to include the hashed passwords. Defaults to false.
+
+    pw_file
+        Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
+
+    prefix
+        Only list users whose username starts with this string.
+
+    limit
+        Maximum number of users to list. Defaults to all.
+
+    offset
+        Number of (matching) users to skip. Defaults to 0.
+
+    chunk_size
+        Number of users per chunk. Defaults to 1000.
+
+    Yields lists of usernames or, if ``include_pass`` is true,
+    mappings of usernames to password hashes.
     """
-    List all Mosquitto users.
+
+    entries = mosquitto.iter_pw_file(
+        pw_file, include_pass=include_pass, prefix=prefix, limit=limit, offset=offset
+    )
+    for chunk in mosquitto.chunked(entries, chunk_size):
+        yield dict(chunk) if include_pass else chunk
+
+
+def list_users(
+    include_pass=False,
+    pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    prefix=None,
+    limit=None,
+    offset=0,
+):
+    """
+    List Mosquitto users.
 
     CLI Example:
 
@@ -164,9 +696,322 @@ def list_users(include_pass=False, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
 
     pw_file
         Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
+
+    prefix
+        Only list users whose username starts with this string.
+
+    limit
+        Maximum number of users to list. Defaults to all.
+
+    offset
+        Number of (matching) users to skip. Defaults to 0.
+    """
+
+    with _profile().phase("read"):
+        if prefix is None and limit is None and not offset:
+            return mosquitto.read_pw_file(pw_file, include_pass=include_pass)
+
+        entries = mosquitto.iter_pw_file(
+            pw_file,
+            include_pass=include_pass,
+            prefix=prefix,
+            limit=limit,
+            offset=offset,
+        )
+        return dict(entries) if include_pass else list(entries)
+
+
+def meross_accounts(devices):
+    """
+    Derive the accounts and ACL entries of Meross devices in a single pass.
+    Meross devices authenticate with their MAC address as the username and
+    ``<userid>_md5(<mac><key>)`` as the password. They subscribe to
+    ``/appliance/<uuid>/subscribe`` and publish to ``/appliance/<uuid>/publish``.
+    Used by the formula's ``meross`` plugin.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.meross_accounts '[{mac: "48:e1:e9:00:00:01", uuid: 2004..., key_pillar: meross:key}]'
+
+    devices
+        List of devices, a device being a mapping of ``mac``, ``uuid``, ``key``
+        or ``key_pillar`` (a pillar key to look up the key), ``userid``
+        (defaults to 0) and ``user_opts`` (additional user parameters).
+
+    Returns a mapping with ``users`` in the format of the formula's ``users:present``
+    configuration and ``acl`` in the format of its ``acl:user`` configuration.
+    """
+
+    users = {}
+    acl = {}
+    for dev in devices or []:
+        try:
+            mac, uuid = dev["mac"], dev["uuid"]
+        except KeyError as e:
+            raise SaltInvocationError(f"Meross device is missing {e}: {dev}")
+        key = dev.get("key")
+        if not key and dev.get("key_pillar"):
+            key = salt.utils.data.traverse_dict_and_list(__pillar__, dev["key_pillar"])
+        if not key:
+            raise SaltInvocationError(f"Found no key for Meross device {mac}.")
+        key_hash = hashlib.md5(f"{mac}{key}".encode()).hexdigest()
+        users[mac] = dict(dev.get("user_opts") or {})
+        users[mac]["password"] = f"{dev.get('userid', 0)}_{key_hash}"
+        dev_acl = acl.setdefault(mac, {"read": [], "write": []})
+        dev_acl["read"].append(f"/appliance/{uuid}/subscribe")
+        dev_acl["write"].append(f"/appliance/{uuid}/publish")
+    return {"users": users, "acl": acl}
+
+
+def needs_rehash(pw_hash, pbkdf2=True, iterations=101):
+    """
+    Check whether a Mosquitto password hash was generated with
+    different parameters than the specified ones.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.needs_rehash '$7$101$...' iterations=1000
+
+    pw_hash
+        The password hash to check.
+
+    pbkdf2
+        Whether the pbkdf2_sha512 hashing algorithm should be used. Defaults to true.
+
+    iterations
+        If pbkdf2 is true, number of hashing iterations. Defaults to 101 (mosquitto default).
+    """
+
+    try:
+        pw = mosquitto.MosquittoPassword.from_string(pw_hash)
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+    if pw.algo != ("pbkdf2" if pbkdf2 else "sha512"):
+        return True
+    return pbkdf2 and pw.iterations != int(iterations)
+
+
+def parse_config(conf_file=MOSQUITTO_DEFAULT_CONF_PATH, contents=None):
     """
+    Parse a Mosquitto configuration file into a normalized model with
+    the keys ``global``, ``auth_opt`` and ``listeners``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.parse_config
+
+    conf_file
+        Path to the configuration file. Defaults to "/etc/mosquitto/mosquitto.conf".
 
-    return mosquitto.read_pw_file(pw_file, include_pass=include_pass)
+    contents
+        Parse this string instead of ``conf_file``.
+    """
+
+    if contents is None:
+        try:
+            contents = Path(conf_file).read_text()
+        except FileNotFoundError:
+            raise CommandExecutionError(f"Configuration file {conf_file} does not exist.")
+
+    try:
+        return mosquitto_config.parse_config(contents)
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+
+def profile_report(fire_event=False, tag="salt/mosquitto/profile"):
+    """
+    Return the wall time and call counts per phase (read, verify, hash, write,
+    sqlite_query, state) recorded by this formula's modules during the current run.
+    Recording needs to be enabled by setting ``mosquitto.profile: true``
+    in the minion configuration or by calling ``mosquitto.profile_start`` first.
+    SQLite statements are only counted, their time is part of the surrounding phase.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.profile_report
+
+    fire_event
+        Send the report as an event to the master. Defaults to false.
+
+    tag
+        The event tag. Defaults to ``salt/mosquitto/profile``.
+    """
+
+    phases = mosquitto.profiler(__context__, __opts__).totals()
+    if fire_event:
+        __salt__["event.send"](tag, {"id": __opts__.get("id"), "phases": phases})
+    return phases
+
+
+def profile_start():
+    """
+    Start recording wall time and call counts per phase for the rest of the
+    current run, regardless of the ``mosquitto.profile`` minion configuration.
+    Discards previously recorded data.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.profile_start
+    """
+
+    mosquitto.start_profile(__context__)
+    return True
+
+
+def reload(name="mosquitto", pid=None, pidfile=None, user=None):
+    """
+    Make a running Mosquitto broker reload its configuration, password and ACL
+    files by sending it SIGHUP. In contrast to a restart, this does not drop
+    client connections.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.reload user=mosquitto
+
+    name
+        The name of the container the broker runs in. Defaults to ``mosquitto``.
+
+    pid
+        Signal the process with this PID directly instead of the container.
+
+    pidfile
+        Read the PID of the process to signal from this file instead.
+
+    user
+        For rootless containers, the user account the container runs under.
+    """
+
+    if pidfile is not None:
+        try:
+            pid = int(Path(pidfile).read_text().strip())
+        except (OSError, ValueError) as e:
+            raise CommandExecutionError(f"Could not read PID from {pidfile}: {e}")
+
+    if pid is not None:
+        try:
+            os.kill(int(pid), signal.SIGHUP)
+        except ProcessLookupError:
+            raise CommandExecutionError(f"Process {pid} does not exist.")
+        except PermissionError:
+            raise CommandExecutionError(f"Not permitted to signal process {pid}.")
+        return True
+
+    runtime = salt.utils.path.which("podman") or salt.utils.path.which("docker")
+    if runtime is None:
+        raise CommandExecutionError("Neither podman nor docker could be found.")
+
+    env = {}
+    if user is not None:
+        uid = __salt__["user.info"](user).get("uid")
+        if uid is None:
+            raise CommandExecutionError(f"User {user} does not exist.")
+        # rootless podman needs the user session
+        env["XDG_RUNTIME_DIR"] = f"/run/user/{uid}"
+
+    res = __salt__["cmd.run_all"](
+        [runtime, "kill", "--signal", "HUP", name],
+        runas=user,
+        env=env,
+        python_shell=False,
+    )
+    if res["retcode"]:
+        raise CommandExecutionError(
+            f"Failed sending SIGHUP to container {name}: {res['stderr'] or res['stdout']}"
+        )
+    return True
+
+
+def render_acl(acl=None):
+    """
+    Render the contents of a Mosquitto ACL file in a single pass. The output
+    is identical to the formula's ``acl.j2`` template, but invalid permissions
+    raise an error instead of being skipped silently. Can be used as
+    ``file.managed`` ``contents``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.render_acl '{user: {elliot: {read: [nabokov/lolita]}}}'
+
+    acl
+        Mapping in the format of the formula's ``acl`` configuration
+        (``anonymous``, ``user``, ``pattern``).
+    """
+
+    try:
+        return mosquitto_acl.render_acl(acl)
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+
+def render_config(config=None):
+    """
+    Render the contents of ``mosquitto.conf`` in a single pass. The output
+    is identical to the formula's ``mosquitto.conf.j2`` template.
+    Can be used as ``file.managed`` ``contents``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.render_config '{persistence: true, listener 1883: {protocol: mqtt}}'
+
+    config
+        Mapping of configuration values in the format of the formula's
+        ``config`` configuration.
+    """
+
+    return mosquitto_config.render_config(config or {})
+
+
+def resolve_sources(sources, saltenv=None):
+    """
+    Return the first of a list of ``file.managed`` sources that exists on the
+    fileserver, like ``file.source_list`` does. Used by ``files_switch``
+    to pass a single source to ``file.managed``, which skips the lookup
+    there entirely.
+
+    The fileserver is only queried once per run for the files and directories
+    below the top-level directory of the ``salt://`` sources, results are
+    cached per list of sources. If the sources cannot be resolved (no match,
+    sources that are not ``salt://`` URLs before a match), they are returned
+    unchanged.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.resolve_sources '[salt://mosquitto/files/id/foo/acl, salt://mosquitto/files/default/acl]'
+
+    sources
+        Ordered list of sources to check.
+
+    saltenv
+        The default salt environment of the sources. Defaults to the configured one or ``base``.
+    """
+
+    saltenv = saltenv or __opts__.get("saltenv") or "base"
+    sources = list(sources)
+    cache = __context__.setdefault("mosquitto.resolved_sources", {})
+    key = json.dumps([saltenv, sources], default=str)
+    if key not in cache:
+        cache[key] = _resolve_sources(sources, saltenv)
+    return cache[key]
 
 
 def rm_user(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
@@ -191,7 +1036,49 @@ def rm_user(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
     if username not in users:
         raise CommandExecutionError(f"User {username} does not exist.")
     users.pop(username)
-    return mosquitto.write_pw_file(pw_file, users)
+    with _profile().phase("write"):
+        return mosquitto.write_pw_file(pw_file, users)
+
+
+def set_users(users=None, remove=None, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
+    """
+    Add, update and remove multiple Mosquitto users at once.
+    The password file is read and written a single time only.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto.set_users '{foo: $7$101$...}' remove='[bar]'
+
+    users
+        Mapping of usernames to password hashes the users should have.
+        Generate them with ``mosquitto.get_pw_hash``.
+
+    remove
+        List of usernames that should be absent. Missing users are ignored.
+
+    pw_file
+        Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
+
+    Returns whether the backend was modified.
+    """
+
+    users = {str(username): pw_hash for username, pw_hash in (users or {}).items()}
+    remove = [str(username) for username in remove or []]
+
+    invalid = [username for username in users if not _validate_username(username)]
+    if invalid:
+        raise CommandExecutionError(
+            f"Usernames {', '.join(invalid)} are invalid. Make sure they do not contain a colon or control characters."
+        )
+
+    current = list_users(include_pass=True, pw_file=pw_file)
+    current.update(users)
+    for username in remove:
+        current.pop(username, None)
+    with _profile().phase("write"):
+        return mosquitto.write_pw_file(pw_file, current)
 
 
 def user_exists(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
@@ -211,7 +1098,117 @@ def user_exists(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
         Path to the file that contains usernames and passwords. Defaults to "/etc/mosquitto/passwd".
     """
 
-    return username in list_users(pw_file=pw_file)
+    with _profile().phase("read"):
+        return mosquitto.read_pw_entry(pw_file, username) is not None
+
+
+def _canonicalize(data):
+    """
+    Stringify mapping keys, which can mix types (e.g. int and str) that
+    ``sort_keys`` cannot order. ``repr`` keeps ``1`` and ``"1"`` apart.
+    """
+    if isinstance(data, dict):
+        return {repr(key): _canonicalize(val) for key, val in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [_canonicalize(val) for val in data]
+    if isinstance(data, (set, frozenset)):
+        return sorted(repr(val) for val in data)
+    return data
+
+
+def _get_acl_index(acl=None, acl_file=MOSQUITTO_DEFAULT_ACL_PATH):
+    """
+    Compile an ACL index, cached in __context__. File-based indexes
+    are invalidated when the file changes.
+    """
+    cache = __context__.setdefault("mosquitto.acl_index", {})
+
+    if acl is not None:
+        key = json.dumps(acl, sort_keys=True, default=str)
+        if key not in cache:
+            try:
+                cache[key] = (None, mosquitto_acl.AclIndex.from_data(acl))
+            except ValueError as e:
+                raise CommandExecutionError(str(e))
+        return cache[key][1]
+
+    try:
+        stat = os.stat(acl_file)
+    except FileNotFoundError:
+        raise CommandExecutionError(f"ACL file {acl_file} does not exist.")
+
+    stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = cache.get(acl_file)
+    if cached is None or cached[0] != stamp:
+        try:
+            cache[acl_file] = (
+                stamp,
+                mosquitto_acl.AclIndex.from_string(Path(acl_file).read_text()),
+            )
+        except ValueError as e:
+            raise CommandExecutionError(f"Could not parse {acl_file}: {e}")
+    return cache[acl_file][1]
+
+
+def _list_master(saltenv, prefix):
+    """
+    Index of the files and directories on the fileserver below ``prefix``,
+    cached in __context__.
+    """
+    cache = __context__.setdefault("mosquitto.list_master", {})
+    if (saltenv, prefix) not in cache:
+        index = set(__salt__["cp.list_master"](saltenv=saltenv, prefix=prefix))
+        index.update(__salt__["cp.list_master_dirs"](saltenv=saltenv, prefix=prefix))
+        cache[(saltenv, prefix)] = index
+    return cache[(saltenv, prefix)]
+
+
+def _mapdata_fingerprint(tplroot):
+    """
+    Hash the grains, pillar and environments the mapdata was rendered from.
+    Returns None if they cannot be serialized, which disables the cache.
+    """
+    fingerprint = hashlib.sha256()
+    try:
+        for part in (
+            tplroot,
+            __opts__.get("saltenv"),
+            __opts__.get("pillarenv"),
+            # the dunders can be loader proxies, which are not serializable
+            {key: __grains__[key] for key in __grains__},
+            {key: __pillar__[key] for key in __pillar__},
+        ):
+            serialized = json.dumps(_canonicalize(part), sort_keys=True, default=repr)
+            fingerprint.update(serialized.encode() + b"\0")
+    except (TypeError, ValueError, RecursionError):
+        return None
+    return fingerprint.hexdigest()
+
+
+def _parse_acl_check(check):
+    """
+    Convert a batch check into the (topic, access, username, clientid)
+    argument tuple of the ACL index.
+    """
+    if isinstance(check, dict):
+        return (
+            check["topic"],
+            check.get("access", "read"),
+            check.get("username"),
+            check.get("clientid"),
+        )
+    username, clientid, topic, *access = check
+    return (topic, access[0] if access else "read", username, clientid)
+
+
+def _resolve_sources(sources, saltenv):
+    for source in sources:
+        if not isinstance(source, str) or not source.startswith("salt://"):
+            return sources
+        path, senv = salt.utils.url.parse(source)
+        if path in _list_master(senv or saltenv, path.split("/")[0]):
+            return source
+    return sources
 
 
 def _validate_username(username):
@@ -219,8 +1216,8 @@ def _validate_username(username):
     Mosquitto usernames must not contain control characters, colons or be longer than 2**16 bytes.
     """
 
-    if len(str(username)) > 65536:
-        return False
-    if not re.match(r"^((?=[^\x00-\x1F\x7F\u2028\u2029]).)*$", username):
-        return False
-    return True
+    return mosquitto.validate_username(username)
+
+
+def _profile():
+    return mosquitto.profiler(__context__, __opts__)
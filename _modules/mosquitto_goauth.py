@@ -4,6 +4,9 @@ Salt execution module to manage Eclipse Mosquitto installations using mosquitto-
 This code can actually mostly be used for vanilla Mosquitto as well @TODO resynthesize.
 """
 
+import hashlib
+import json
+import os
 from pathlib import Path
 
 try:
@@ -13,11 +16,13 @@ try:
 except ImportError:
     HAS_SQLITE3 = False
 
+import salt.utils.atomicfile
 import salt.utils.path
 from salt.exceptions import CommandExecutionError, SaltInvocationError
 
 # __utils__ dunder is deprecated
 import mosquitto
+import mosquitto_acl
 
 __virtualname__ = "mosquitto_goauth"
 
@@ -34,6 +39,7 @@ def add_user(
     password_hash=None,
     update=False,
     pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    append=False,
 ):
     """
     Add or update a Mosquitto user.
@@ -62,6 +68,13 @@ def add_user(
     pw_file
         Path to the database/file that contains usernames and passwords. Defaults to
         ``/etc/mosquitto/passwd``. SQLite databases will be autodetected and treated as such.
+
+    append
+        For the file backend: If the user does not exist yet, append it to the file
+        instead of rewriting the whole file. Run ``mosquitto.compact_pw_file``
+        afterwards to restore the sort order. Defaults to false.
+
+    Returns whether the backend was modified. Setting an identical hash does not modify it.
     """
 
     if password is None and password_hash is None:
@@ -71,11 +84,16 @@ def add_user(
 
     users = _get_collection(pw_file)
     password_hash = password_hash or get_pw_hash(password)
-    return users.add(username, password_hash, update=update)
+    with _profile().phase("write"):
+        return users.add(username, password_hash, update=update, append=append)
 
 
 def check_password(
-    password, username=None, pw_hash=None, pw_file=MOSQUITTO_DEFAULT_PW_PATH
+    password,
+    username=None,
+    pw_hash=None,
+    pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    cache=True,
 ):
     """
     Check a Mosquitto Go Auth password.
@@ -98,6 +116,13 @@ def check_password(
     pw_file
         Path to the database/file that contains usernames and passwords. Defaults to
         ``/etc/mosquitto/passwd``. SQLite databases will be autodetected and treated as such.
+
+    cache
+        Consult the verified password cache in the minion cachedir before
+        running the key derivation function and record successful verifications there.
+        Defaults to true. Can be disabled globally by setting ``mosquitto.verify_cache: false``
+        in the minion configuration, its size is controlled by ``mosquitto.verify_cache_size``
+        (defaults to 65536 entries).
     """
 
     if pw_hash is None and (username is None or pw_file is None):
@@ -107,15 +132,77 @@ def check_password(
 
     if username is not None and pw_file is not None:
         users = _get_collection(pw_file)
-        pw_hash = users.get_password(username)
+        with _profile().phase("read"):
+            pw_hash = users.get_password(username)
+
+    with _profile().phase("verify"):
+        try:
+            pw = mosquitto.MosquittoGoauthHasher.from_string(pw_hash)
+        except ValueError as e:
+            raise CommandExecutionError(str(e))
+        verify_cache = mosquitto.verified_password_cache(__context__, __opts__)
+
+        if not cache or verify_cache is None:
+            return pw.check_password(password)
+        return verify_cache.check(
+            pw_hash, password, lambda: pw.check_password(password)
+        )
 
-    return mosquitto.MosquittoGoauthPassword.from_string(pw_hash).check_password(
-        password
-    )
+
+def check_passwords(pairs, workers=None, processes=False, cache=True):
+    """
+    Check many Mosquitto Go Auth passwords at once. The hashes are computed
+    on a pool of workers, which scales with the number of CPU cores.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.check_passwords '[[hunter1, PBKDF2$sha512$...], [hunter2, PBKDF2$sha512$...]]'
+
+    pairs
+        List of (password, pw_hash) pairs to check.
+
+    workers
+        Number of parallel workers. Defaults to the number of CPU cores.
+
+    processes
+        Use a process pool instead of a thread pool. Defaults to false.
+
+    cache
+        Consult the verified password cache before hashing and record successful
+        verifications there. Defaults to true. See ``check_password``.
+
+    Returns a list of booleans in the order of ``pairs``.
+    """
+
+    verify_cache = None
+    if cache:
+        verify_cache = mosquitto.verified_password_cache(__context__, __opts__)
+
+    try:
+        with _profile().phase("verify", calls=len(pairs)):
+            return mosquitto.check_passwords(
+                mosquitto.MosquittoGoauthHasher,
+                [tuple(pair) for pair in pairs],
+                workers=workers,
+                processes=processes,
+                verify_cache=verify_cache,
+            )
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
 
 
 def get_pw_hash(
-    password, iterations=100000, hmac_hash="sha512", keylen=32, salt_size=16
+    password,
+    iterations=None,
+    hmac_hash="sha512",
+    keylen=32,
+    salt_size=16,
+    hasher="pbkdf2",
+    cost=10,
+    memory=4096,
+    parallelism=2,
 ):
     """
     Get a password hash suitable for Mosquitto Go Auth.
@@ -125,40 +212,209 @@ def get_pw_hash(
     .. code-block:: bash
 
         salt '*' mosquitto_goauth.get_pw_hash hunter1
+        salt '*' mosquitto_goauth.get_pw_hash hunter1 hasher=argon2id memory=65536
 
     password
         The password to hash.
 
+    hasher
+        The mosquitto-go-auth hasher to use. One of ["pbkdf2", "bcrypt", "argon2id"].
+        Defaults to pbkdf2 (mosquitto-go-auth default). bcrypt requires the ``bcrypt``,
+        argon2id the ``argon2-cffi`` Python library.
+
     iterations
-        Number of hashing iterations. Defaults 100000 (mosquitto-go-auth default).
+        Number of hashing iterations (pbkdf2, argon2id). Defaults to 100000 for pbkdf2
+        and 3 for argon2id (mosquitto-go-auth defaults).
 
     hmac_hash
-        Hashing algorithm for PBKDF2. One of ["sha512", "sha256"]. Defaults to sha512 (mosquitto-go-auth default.
+        Hashing algorithm for PBKDF2. One of ["sha512", "sha256"]. Defaults to sha512 (mosquitto-go-auth default).
 
     keylen
-        Byte count of the resulting hash. Defaults to 32 (mosquitto-go-auth default).
+        Byte count of the resulting hash (pbkdf2, argon2id). Defaults to 32 (mosquitto-go-auth default).
 
     salt_size
-        Byte count of the random salt. Defaults to 16 (mosquitto-go-auth default).
+        Byte count of the random salt (pbkdf2, argon2id). Defaults to 16 (mosquitto-go-auth default).
+
+    cost
+        bcrypt cost factor (log2 of the number of rounds). Defaults to 10 (mosquitto-go-auth default).
+
+    memory
+        argon2id memory cost in KiB. Defaults to 4096 (mosquitto-go-auth default).
+
+    parallelism
+        argon2id number of lanes. Defaults to 2 (mosquitto-go-auth default).
     """
 
     try:
-        pw = mosquitto.MosquittoGoauthPassword.from_password(
-            password,
-            hmac_hash=hmac_hash,
+        with _profile().phase("hash"):
+            return mosquitto.MosquittoGoauthHasher.from_password(
+                password,
+                **_hash_opts(
+                    hasher,
+                    iterations=iterations,
+                    hmac_hash=hmac_hash,
+                    keylen=keylen,
+                    salt_size=salt_size,
+                    cost=cost,
+                    memory=memory,
+                    parallelism=parallelism,
+                ),
+            ).to_string()
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+
+def get_pw_hashes(
+    passwords,
+    iterations=None,
+    hmac_hash="sha512",
+    keylen=32,
+    salt_size=16,
+    hasher="pbkdf2",
+    cost=10,
+    memory=4096,
+    parallelism=2,
+    workers=None,
+    processes=False,
+):
+    """
+    Get many password hashes suitable for Mosquitto Go Auth at once. The hashes are
+    computed on a pool of workers, which scales with the number of CPU cores.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.get_pw_hashes '[hunter1, hunter2]'
+
+    passwords
+        List of passwords to hash.
+
+    hasher, iterations, hmac_hash, keylen, salt_size, cost, memory, parallelism
+        See ``get_pw_hash``.
+
+    workers
+        Number of parallel workers. Defaults to the number of CPU cores.
+
+    processes
+        Use a process pool instead of a thread pool. Defaults to false.
+
+    Returns a list of hashes in the order of ``passwords``.
+    """
+
+    try:
+        hash_opts = _hash_opts(
+            hasher,
             iterations=iterations,
+            hmac_hash=hmac_hash,
             keylen=keylen,
             salt_size=salt_size,
+            cost=cost,
+            memory=memory,
+            parallelism=parallelism,
         )
+        with _profile().phase("hash", calls=len(passwords)):
+            return mosquitto.get_pw_hashes(
+                mosquitto.MosquittoGoauthHasher.get(hash_opts.pop("hasher")),
+                passwords,
+                workers=workers,
+                processes=processes,
+                **hash_opts,
+            )
     except ValueError as e:
         raise CommandExecutionError(str(e))
 
-    return pw.to_string()
 
+def get_stored_hash(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
+    """
+    Return the stored password hash of a single user or None if the user
+    does not exist. This is a point lookup, the backend is not listed.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.get_stored_hash foo
+
+    username
+        The user's username.
 
-def list_users(include_pass=False, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
+    pw_file
+        Path to the database/file that contains usernames and passwords. Defaults to
+        ``/etc/mosquitto/passwd``. SQLite databases will be autodetected and treated as such.
     """
-    List all Mosquitto users.
+
+    users = _get_collection(pw_file)
+    with _profile().phase("read"):
+        try:
+            return users.get_password(username)
+        except CommandExecutionError:
+            return None
+
+
+def iter_users(
+    include_pass=False,
+    pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    prefix=None,
+    limit=None,
+    offset=0,
+    chunk_size=1000,
+):
+    """
+    Stream Mosquitto users in chunks. Files are read line by line, SQLite rows
+    are fetched ``chunk_size`` at a time. Only the read side is chunked though:
+    When called via the CLI, Salt collects all chunks into the job return,
+    so memory usage still grows with the number of users. Export large
+    backends page by page with ``limit``/``offset`` instead.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.iter_users prefix=device_ limit=100
+        salt '*' mosquitto_goauth.iter_users limit=10000 offset=20000
+
+    include_pass
+        Whether to include the password hashes. Defaults to false.
+
+    pw_file
+        Path to the database/file that contains usernames and passwords. Defaults to
+        ``/etc/mosquitto/passwd``. SQLite databases will be autodetected and treated as such.
+
+    prefix
+        Only list users whose username starts with this string.
+
+    limit
+        Maximum number of users to list. Defaults to all.
+
+    offset
+        Number of (matching) users to skip. Defaults to 0.
+
+    chunk_size
+        Number of users per chunk. Defaults to 1000.
+
+    Yields lists of usernames or, if ``include_pass`` is true,
+    mappings of usernames to password hashes. SQLite users are ordered
+    by username, file users in file order.
+    """
+
+    users = _get_collection(pw_file)
+    entries = users.iter_ls(
+        include_pass, prefix=prefix, limit=limit, offset=offset, chunk_size=chunk_size
+    )
+    for chunk in mosquitto.chunked(entries, chunk_size):
+        yield dict(chunk) if include_pass else chunk
+
+
+def list_users(
+    include_pass=False,
+    pw_file=MOSQUITTO_DEFAULT_PW_PATH,
+    prefix=None,
+    limit=None,
+    offset=0,
+):
+    """
+    List Mosquitto users.
 
     CLI Example:
 
@@ -172,10 +428,256 @@ def list_users(include_pass=False, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
     pw_file
         Path to the database/file that contains usernames and passwords. Defaults to
         ``/etc/mosquitto/passwd``. SQLite databases will be autodetected and treated as such.
+
+    prefix
+        Only list users whose username starts with this string.
+
+    limit
+        Maximum number of users to list. Defaults to all.
+
+    offset
+        Number of (matching) users to skip. Defaults to 0.
     """
 
     users = _get_collection(pw_file)
-    return users.ls(include_pass)
+    with _profile().phase("read"):
+        if prefix is None and limit is None and not offset:
+            return users.ls(include_pass)
+
+        entries = users.iter_ls(
+            include_pass, prefix=prefix, limit=limit, offset=offset
+        )
+        return dict(entries) if include_pass else list(entries)
+
+
+def migrate_users(
+    source,
+    target,
+    batch_size=1000,
+    checkpoint=None,
+    resume=True,
+    verify=True,
+    test=False,
+):
+    """
+    Copy the users of one backend into another, e.g. from a password file into
+    a SQLite database. Password hashes are copied as they are, nothing is rehashed.
+    Users that only exist in the target are kept.
+
+    The source is streamed in batches of ``batch_size`` users. SQLite targets are
+    written in one transaction per batch, after which the position in the source
+    is recorded in a checkpoint. An interrupted migration resumes from there.
+    File targets are written once at the end.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.migrate_users /etc/mosquitto/passwd /etc/mosquitto/auth.db test=true
+
+    source
+        Path to the database/file to read the users from.
+        SQLite databases will be autodetected and treated as such.
+
+    target
+        Path to the database/file to write the users to. Needs to exist.
+        SQLite databases will be autodetected and treated as such.
+
+    batch_size
+        Number of users per batch. Defaults to 1000.
+
+    checkpoint
+        Path to the checkpoint file. Defaults to a file in the
+        ``mosquitto/migrations`` directory of the minion cachedir.
+        It is removed after a successful migration.
+
+    resume
+        Resume from the checkpoint, if there is one. It is ignored if the
+        source changed before the recorded position. Defaults to true.
+
+    verify
+        After the migration, check that all users of the source have
+        the same hash in the target. Defaults to true.
+
+    test
+        Only report the users that would be added or updated. Defaults to false.
+
+    Returns a mapping of ``added`` and ``updated`` usernames, the number of
+    ``unchanged`` users, the source position the migration was ``resumed`` at
+    and the number of ``verified`` users.
+    """
+
+    if os.path.realpath(source) == os.path.realpath(target):
+        raise SaltInvocationError("Source and target need to be different.")
+    batch_size = int(batch_size)
+    if batch_size < 1:
+        raise SaltInvocationError("batch_size needs to be a positive integer.")
+
+    src = _get_collection(source)
+    dst = _get_collection(target)
+    checkpoint = Path(checkpoint or _migration_checkpoint(source, target))
+    position = 0
+    if resume:
+        position = _read_migration_checkpoint(src, checkpoint, source, target)
+    ret = {"added": [], "updated": [], "unchanged": 0, "resumed": position}
+
+    # files are rewritten as a whole, so they are read and written once only
+    batched = isinstance(dst, SQLiteUserCollection)
+    if not batched:
+        with _profile().phase("read"):
+            existing = dst.ls(include_pass=True)
+        pending = {}
+
+    entries = src.iter_ls(include_pass=True, offset=position, chunk_size=batch_size)
+    for batch in mosquitto.chunked(entries, batch_size):
+        if batched:
+            with _profile().phase("read"):
+                existing = dst.get_passwords([username for username, _ in batch])
+        changed = {}
+        for username, pw_hash in batch:
+            if existing.get(username) == pw_hash:
+                ret["unchanged"] += 1
+                continue
+            if not _validate_username(username, dst):
+                raise CommandExecutionError(
+                    f"Username {username} is invalid for the target backend."
+                )
+            ret["updated" if username in existing else "added"].append(username)
+            changed[username] = pw_hash
+        position += len(batch)
+
+        if test:
+            continue
+        if not batched:
+            pending.update(changed)
+            continue
+        if changed:
+            with _profile().phase("write"):
+                dst.set(changed, [])
+        _write_migration_checkpoint(checkpoint, source, target, position, batch[-1][0])
+
+    if test:
+        return ret
+
+    if not batched and pending:
+        with _profile().phase("write"):
+            dst.set(pending, [])
+    checkpoint.unlink(missing_ok=True)
+
+    if verify:
+        ret["verified"] = _verify_migration(src, dst, batch_size)
+    return ret
+
+
+def migrate_schema(pw_file=MOSQUITTO_DEFAULT_PW_PATH, wal=True, test=False):
+    """
+    Migrate the schema of a SQLite user database. Removes duplicate usernames
+    (keeping the most recent row), creates a unique index on ``users.username``
+    and optionally switches the database to WAL journal mode, which allows the
+    broker to read while Salt writes. If there is an ``acls`` table, duplicate
+    rules are removed as well and a unique index on ``acls.username, acls.topic``
+    is created.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.migrate_schema /etc/mosquitto/auth.db
+
+    pw_file
+        Path to the SQLite database that contains usernames and passwords.
+
+    wal
+        Enable the WAL journal mode. The ``-wal`` and ``-shm`` files
+        are given the owner and group of the database, which needs to be
+        group-writable for the broker to read it. Defaults to true.
+
+    test
+        Only report the changes that would be made. Defaults to false.
+
+    Returns a mapping of the performed (or pending) changes.
+    """
+
+    if not _check_sqlite_file(pw_file):
+        raise CommandExecutionError(f"{pw_file} is not a SQLite database.")
+
+    collection = _get_collection(pw_file)
+    return collection.migrate(wal=wal, test=test)
+
+
+def needs_rehash(
+    pw_hash,
+    iterations=None,
+    hmac_hash="sha512",
+    keylen=32,
+    salt_size=16,
+    hasher="pbkdf2",
+    cost=10,
+    memory=4096,
+    parallelism=2,
+):
+    """
+    Check whether a Mosquitto Go Auth password hash was generated with
+    a different hasher or different parameters than the specified ones.
+    The hasher of ``pw_hash`` is detected automatically.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.needs_rehash 'PBKDF2$sha512$100000$...' keylen=64
+
+    pw_hash
+        The password hash to check.
+
+    hasher
+        The mosquitto-go-auth hasher to use. One of ["pbkdf2", "bcrypt", "argon2id"].
+        Defaults to pbkdf2 (mosquitto-go-auth default). bcrypt requires the ``bcrypt``,
+        argon2id the ``argon2-cffi`` Python library.
+
+    iterations
+        Number of hashing iterations (pbkdf2, argon2id). Defaults to 100000 for pbkdf2
+        and 3 for argon2id (mosquitto-go-auth defaults).
+
+    hmac_hash
+        Hashing algorithm for PBKDF2. One of ["sha512", "sha256"]. Defaults to sha512 (mosquitto-go-auth default).
+
+    keylen
+        Byte count of the resulting hash (pbkdf2, argon2id). Defaults to 32 (mosquitto-go-auth default).
+
+    salt_size
+        Byte count of the random salt (pbkdf2, argon2id). Defaults to 16 (mosquitto-go-auth default).
+
+    cost
+        bcrypt cost factor (log2 of the number of rounds). Defaults to 10 (mosquitto-go-auth default).
+
+    memory
+        argon2id memory cost in KiB. Defaults to 4096 (mosquitto-go-auth default).
+
+    parallelism
+        argon2id number of lanes. Defaults to 2 (mosquitto-go-auth default).
+    """
+
+    try:
+        pw = mosquitto.MosquittoGoauthHasher.from_string(pw_hash)
+        wanted = _hash_opts(
+            hasher,
+            iterations=iterations,
+            hmac_hash=hmac_hash,
+            keylen=keylen,
+            salt_size=salt_size,
+            cost=cost,
+            memory=memory,
+            parallelism=parallelism,
+        )
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+    wanted.pop("hasher")
+    return pw.hasher != hasher or pw.params != {
+        param: val if "hmac_hash" == param else int(val)
+        for param, val in wanted.items()
+    }
 
 
 def rm_user(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
@@ -197,7 +699,140 @@ def rm_user(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
     """
 
     users = _get_collection(pw_file)
-    return users.rm(username)
+    with _profile().phase("write"):
+        return users.rm(username)
+
+
+def set_users(users=None, remove=None, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
+    """
+    Add, update and remove multiple Mosquitto users at once.
+    The backend is read and written a single time only.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.set_users '{foo: PBKDF2$sha512$...}' remove='[bar]'
+
+    users
+        Mapping of usernames to password hashes the users should have.
+        Generate them with ``mosquitto_goauth.get_pw_hash``.
+
+    remove
+        List of usernames that should be absent. Missing users are ignored.
+
+    pw_file
+        Path to the database/file that contains usernames and passwords. Defaults to
+        ``/etc/mosquitto/passwd``. SQLite databases will be autodetected and treated as such.
+
+    Returns whether the backend was modified.
+    """
+
+    users = {str(username): pw_hash for username, pw_hash in (users or {}).items()}
+    remove = [str(username) for username in remove or []]
+    collection = _get_collection(pw_file)
+
+    invalid = [
+        username for username in users if not _validate_username(username, collection)
+    ]
+    if invalid:
+        raise CommandExecutionError(
+            f"Usernames {', '.join(invalid)} are invalid for this backend."
+        )
+
+    with _profile().phase("write"):
+        return collection.set(users, remove)
+
+
+def split_acl(acl=None):
+    """
+    Split an ACL into the rules that can be answered from the indexed ``acls``
+    table of a SQLite database and the ones that need to stay in the ACL file.
+    The table can only grant access to users. Anonymous and pattern rules as
+    well as users with deny rules are kept in the file.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.split_acl acl="$(salt-call --out=json pillar.get mosquitto:acl)"
+
+    acl
+        Mapping in the format of the formula's ``acl`` configuration
+        (``anonymous``, ``user``, ``pattern``).
+
+    Returns a mapping with the ``acl`` to render into the ACL file and the
+    ``table`` rules as a mapping of usernames to topics to the go-auth
+    access bitmask (read 1, write 2, subscribe 4).
+    """
+
+    try:
+        rows, remaining = mosquitto_acl.split_sqlite_acl(acl)
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+    table = {}
+    for (username, topic), rw in rows.items():
+        table.setdefault(username, {})[topic] = rw
+    return {"acl": remaining, "table": table}
+
+
+def sync_acls(pw_file, acl=None, test=False):
+    """
+    Synchronize the ``acls`` table of a SQLite database with an ACL, inserting,
+    updating and deleting the differing rows only. Rules that cannot be
+    answered from the table are skipped, see ``split_acl``.
+    go-auth can query the table with:
+
+    .. code-block:: sql
+
+        SELECT topic FROM acls WHERE username = ? AND (rw & ?) != 0
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' mosquitto_goauth.sync_acls /etc/mosquitto/auth.db acl="$(salt-call --out=json pillar.get mosquitto:acl)"
+
+    pw_file
+        Path to the SQLite database that contains the ``acls`` table.
+
+    acl
+        Mapping in the format of the formula's ``acl`` configuration
+        (``anonymous``, ``user``, ``pattern``).
+
+    test
+        Only report the changes that would be made. Defaults to false.
+
+    Returns a mapping of ``added``, ``updated`` and ``removed`` rules
+    (username => list of topics). Empty ones are omitted.
+    """
+
+    if not _check_sqlite_file(pw_file):
+        raise CommandExecutionError(f"{pw_file} is not a SQLite database.")
+
+    try:
+        rows, _ = mosquitto_acl.split_sqlite_acl(acl)
+    except ValueError as e:
+        raise CommandExecutionError(str(e))
+
+    collection = _get_collection(pw_file)
+    with _profile().phase("read"):
+        current = collection.acls()
+    added = {key: rw for key, rw in rows.items() if key not in current}
+    updated = {
+        key: rw for key, rw in rows.items() if key in current and current[key] != rw
+    }
+    removed = [key for key in current if key not in rows]
+    if not test and (added or updated or removed):
+        with _profile().phase("write"):
+            collection.set_acls(added, updated, removed)
+
+    changes = {}
+    for name, keys in (("added", added), ("updated", updated), ("removed", removed)):
+        for username, topic in sorted(keys):
+            changes.setdefault(name, {}).setdefault(username, []).append(topic)
+    return changes
 
 
 def user_exists(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
@@ -219,7 +854,19 @@ def user_exists(username, pw_file=MOSQUITTO_DEFAULT_PW_PATH):
     """
 
     users = _get_collection(pw_file)
-    return users.exists(username)
+    with _profile().phase("read"):
+        return users.exists(username)
+
+
+def _validate_username(username, collection):
+    """
+    The file backend has the same restrictions as vanilla Mosquitto,
+    SQLite accepts any username.
+    """
+
+    if isinstance(collection, SQLiteUserCollection):
+        return True
+    return mosquitto.validate_username(username)
 
 
 def _check_sqlite_file(path):
@@ -239,24 +886,170 @@ def _check_sqlite_file(path):
     return __context__[contextkey]
 
 
+def _hash_opts(
+    hasher,
+    iterations=None,
+    hmac_hash="sha512",
+    keylen=32,
+    salt_size=16,
+    cost=10,
+    memory=4096,
+    parallelism=2,
+):
+    """
+    Select the hashing parameters that apply to ``hasher``.
+    """
+    if "pbkdf2" == hasher:
+        return {
+            "hasher": hasher,
+            "iterations": 100000 if iterations is None else iterations,
+            "hmac_hash": hmac_hash,
+            "keylen": keylen,
+            "salt_size": salt_size,
+        }
+    if "bcrypt" == hasher:
+        return {"hasher": hasher, "cost": cost}
+    if "argon2id" == hasher:
+        return {
+            "hasher": hasher,
+            "iterations": 3 if iterations is None else iterations,
+            "memory": memory,
+            "parallelism": parallelism,
+            "keylen": keylen,
+            "salt_size": salt_size,
+        }
+    # raises the appropriate error
+    mosquitto.MosquittoGoauthHasher.get(hasher)
+
+
+def _migration_checkpoint(source, target):
+    return Path(
+        __opts__["cachedir"],
+        "mosquitto",
+        "migrations",
+        hashlib.sha256(
+            f"{os.path.abspath(source)}\0{os.path.abspath(target)}".encode()
+        ).hexdigest()[:16]
+        + ".json",
+    )
+
+
+def _read_migration_checkpoint(src, checkpoint, source, target):
+    """
+    Return the source position to resume a migration at. The checkpoint is only
+    valid if the user it recorded last is still found right before that position,
+    otherwise the migration starts from the beginning, which is safe since
+    unchanged users are skipped.
+    """
+    try:
+        data = json.loads(checkpoint.read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+    if [data.get("source"), data.get("target")] != [
+        os.path.abspath(source),
+        os.path.abspath(target),
+    ]:
+        return 0
+    position = data.get("position") or 0
+    if position < 1:
+        return 0
+    if list(src.iter_ls(offset=position - 1, limit=1)) != [data.get("last")]:
+        return 0
+    return position
+
+
+def _write_migration_checkpoint(checkpoint, source, target, position, last):
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    with salt.utils.atomicfile.atomic_open(str(checkpoint), "w") as f:
+        json.dump(
+            {
+                "source": os.path.abspath(source),
+                "target": os.path.abspath(target),
+                "position": position,
+                "last": last,
+            },
+            f,
+        )
+
+
+def _verify_migration(src, dst, batch_size):
+    """
+    Compare the hashes of all source users with the target in batches.
+    Returns the number of verified users.
+    """
+    verified = 0
+    mismatched = []
+    existing = None
+    if not isinstance(dst, SQLiteUserCollection):
+        existing = dst.ls(include_pass=True)
+    with _profile().phase("verify"):
+        entries = src.iter_ls(include_pass=True, chunk_size=batch_size)
+        for batch in mosquitto.chunked(entries, batch_size):
+            if isinstance(dst, SQLiteUserCollection):
+                existing = dst.get_passwords([username for username, _ in batch])
+            for username, pw_hash in batch:
+                if existing.get(username) == pw_hash:
+                    verified += 1
+                else:
+                    mismatched.append(username)
+    if mismatched:
+        examples = ", ".join(mismatched[:10]) + (", ..." if len(mismatched) > 10 else "")
+        raise CommandExecutionError(
+            f"Verification failed, {len(mismatched)} users differ between "
+            f"source and target: {examples}"
+        )
+    return verified
+
+
+def _prefix_upper_bound(prefix):
+    """
+    Return the smallest string that is greater than all strings starting with
+    ``prefix`` or None if there is none.
+    """
+    prefix = prefix.rstrip(chr(0x10FFFF))
+    if not prefix:
+        return None
+    last = ord(prefix[-1]) + 1
+    if 0xD800 <= last <= 0xDFFF:
+        # surrogates cannot be encoded
+        last = 0xE000
+    return prefix[:-1] + chr(last)
+
+
 def _get_collection(path):
-    if _check_sqlite_file(path):
-        return SQLiteUserCollection(path)
-    return FileUserCollection(path)
+    if not _check_sqlite_file(path):
+        collection = FileUserCollection(path)
+    else:
+        # keep a single connection per database during a Salt run
+        contextkey = f"mosquitto_goauth._get_collection.{path}"
+        if contextkey not in __context__:
+            __context__[contextkey] = SQLiteUserCollection(path)
+        collection = __context__[contextkey]
+    collection.profile = _profile()
+    return collection
+
+
+def _profile():
+    return mosquitto.profiler(__context__, __opts__)
 
 
 class UserCollection:
+    profile = mosquitto.NULL_PROFILE
+
     def __init__(self, pw_file):
         pw_file = Path(pw_file)
         if not pw_file.exists():
             raise CommandExecutionError(f"Path {path} does not exist.")
         self.pw_file = pw_file
 
-    def add(self, username, pw_hash, update=False):
-        if self.exists(username) and not update:
+    def add(self, username, pw_hash, update=False, append=False):
+        exists = self.exists(username)
+        if exists and not update:
             raise CommandExecutionError(
                 f"User {username} exists. To update the password, set update=True."
             )
+        if append and not exists:
+            return self._append(username, pw_hash)
         return self._add(username, pw_hash)
 
     def exists(self, username):
@@ -265,6 +1058,17 @@ class UserCollection:
     def get_password(self, username):
         raise NotImplementedError
 
+    def get_passwords(self, usernames):
+        users = self.ls(include_pass=True)
+        return {
+            username: users[username] for username in usernames if username in users
+        }
+
+    def iter_ls(
+        self, include_pass=False, prefix=None, limit=None, offset=0, chunk_size=1000
+    ):
+        raise NotImplementedError
+
     def ls(self, include_pass=False):
         raise NotImplementedError
 
@@ -273,16 +1077,33 @@ class UserCollection:
             raise CommandExecutionError(f"Username {username} does not exist.")
         return self._rm(username)
 
+    def set(self, users, remove):
+        raise NotImplementedError
+
+    def _append(self, username, pw_hash):
+        return self._add(username, pw_hash)
+
 
 class FileUserCollection(UserCollection):
     def exists(self, username):
-        return username in self.ls()
+        return mosquitto.read_pw_entry(self.pw_file, username) is not None
 
     def get_password(self, username):
-        users = self.ls(True)
-        if username not in users:
+        pw_hash = mosquitto.read_pw_entry(self.pw_file, username)
+        if pw_hash is None:
             raise CommandExecutionError(f"User {username} does not exist.")
-        return users[username]
+        return pw_hash
+
+    def iter_ls(
+        self, include_pass=False, prefix=None, limit=None, offset=0, chunk_size=1000
+    ):
+        return mosquitto.iter_pw_file(
+            self.pw_file,
+            include_pass=include_pass,
+            prefix=prefix,
+            limit=limit,
+            offset=offset,
+        )
 
     def ls(self, include_pass=False):
         return mosquitto.read_pw_file(self.pw_file, include_pass=include_pass)
@@ -292,6 +1113,16 @@ class FileUserCollection(UserCollection):
         users[username] = pw_hash
         return mosquitto.write_pw_file(self.pw_file, users)
 
+    def set(self, users, remove):
+        current = self.ls(include_pass=True)
+        current.update(users)
+        for username in remove:
+            current.pop(username, None)
+        return mosquitto.write_pw_file(self.pw_file, current)
+
+    def _append(self, username, pw_hash):
+        return mosquitto.append_pw_file(self.pw_file, username, pw_hash)
+
     def _rm(self, username):
         users = self.ls(include_pass=True)
         users.pop(username)
@@ -299,6 +1130,16 @@ class FileUserCollection(UserCollection):
 
 
 class SQLiteUserCollection(UserCollection):
+    INDEX_NAME = "users_username_unique"
+    ACL_INDEX_NAME = "acls_username_topic_unique"
+    INSERT = "insert into `users` (username, password_hash, is_admin) VALUES (?, ?, false)"
+    UPDATE = "update `users` set `password_hash` = ? where `username` = ? and `password_hash` != ?"
+    UPSERT = (
+        "insert into `users` (username, password_hash, is_admin) VALUES (?, ?, false) "
+        "on conflict (`username`) do update set `password_hash` = excluded.`password_hash` "
+        "where `password_hash` != excluded.`password_hash`"
+    )
+
     def exists(self, username):
         query = "select count(*) from `users` where `username` = ?"
         cur = self._cur()
@@ -314,6 +1155,48 @@ class SQLiteUserCollection(UserCollection):
             raise CommandExecutionError(f"User {username} does not exist.")
         return res[0]
 
+    def get_passwords(self, usernames):
+        usernames = list(usernames)
+        cur = self._cur()
+        ret = {}
+        # stay below the default limit of host parameters in older SQLite versions
+        for chunk in mosquitto.chunked(usernames, 500):
+            cur.execute(
+                "select `username`, `password_hash` from `users` where `username` in "
+                f"({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            ret.update(cur.fetchall())
+        return ret
+
+    def iter_ls(
+        self, include_pass=False, prefix=None, limit=None, offset=0, chunk_size=1000
+    ):
+        query = "select `username`"
+        if include_pass:
+            query += ", `password_hash`"
+        query += " from `users`"
+        params = []
+        if prefix:
+            # range query to make use of the username index
+            query += " where `username` >= ?"
+            params.append(prefix)
+            upper = _prefix_upper_bound(prefix)
+            if upper is not None:
+                query += " and `username` < ?"
+                params.append(upper)
+        query += " order by `username` limit ? offset ?"
+        params += [-1 if limit is None else limit, offset]
+
+        cur = self._cur()
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row) if include_pass else row[0]
+
     def ls(self, include_pass=False):
         query = "select username"
         if include_pass:
@@ -327,16 +1210,185 @@ class SQLiteUserCollection(UserCollection):
         return [x[0] for x in users]
 
     def _add(self, username, pw_hash):
-        if self.exists(username):
-            query = "update `users` set `password_hash` = ? where `username` = ?"
-            params = [pw_hash, username]
+        cur = self._cur()
+        if self._can_upsert():
+            cur.execute(self.UPSERT, [username, pw_hash])
+        elif self.exists(username):
+            cur.execute(self.UPDATE, [pw_hash, username, pw_hash])
         else:
-            query = "insert into `users` (username, password_hash, is_admin) VALUES (?, ?, false)"
-            params = [username, pw_hash]
+            cur.execute(self.INSERT, [username, pw_hash])
+        return bool(cur.rowcount)
+
+    def set(self, users, remove):
         cur = self._cur()
-        cur.execute(query, params)
+        total_changes = self.connection.total_changes
+        cur.execute("begin immediate")
+        try:
+            if self._can_upsert():
+                cur.executemany(self.UPSERT, users.items())
+            else:
+                existing = set(self.ls())
+                cur.executemany(
+                    self.UPDATE,
+                    [
+                        (pw_hash, username, pw_hash)
+                        for username, pw_hash in users.items()
+                        if username in existing
+                    ],
+                )
+                cur.executemany(
+                    self.INSERT,
+                    [
+                        (username, pw_hash)
+                        for username, pw_hash in users.items()
+                        if username not in existing
+                    ],
+                )
+            cur.executemany(
+                "delete from `users` where `username` = ?",
+                [(username,) for username in remove],
+            )
+        except Exception:
+            cur.execute("rollback")
+            raise
+        cur.execute("commit")
+        return self.connection.total_changes != total_changes
+
+    def acls(self):
+        cur = self._cur()
+        cur.execute("select `username`, `topic`, `rw` from `acls`", [])
+        return {(username, topic): rw for username, topic, rw in cur.fetchall()}
+
+    def set_acls(self, added, updated, removed):
+        cur = self._cur()
+        cur.execute("begin immediate")
+        try:
+            cur.executemany(
+                "insert into `acls` (username, topic, rw) VALUES (?, ?, ?)",
+                [(username, topic, rw) for (username, topic), rw in added.items()],
+            )
+            cur.executemany(
+                "update `acls` set `rw` = ? where `username` = ? and `topic` = ?",
+                [(rw, username, topic) for (username, topic), rw in updated.items()],
+            )
+            cur.executemany(
+                "delete from `acls` where `username` = ? and `topic` = ?", removed
+            )
+        except Exception:
+            cur.execute("rollback")
+            raise
+        cur.execute("commit")
         return True
 
+    def migrate(self, wal=True, test=False):
+        cur = self._cur()
+        changes = {}
+
+        if not self._has_unique_index():
+            cur.execute(
+                "select count(*) - count(distinct `username`) from `users`", []
+            )
+            duplicates = cur.fetchone()[0]
+            if duplicates:
+                changes["duplicates_removed"] = duplicates
+            changes["index_created"] = self.INDEX_NAME
+
+            if not test:
+                cur.execute("begin immediate")
+                try:
+                    cur.execute(
+                        "delete from `users` where `id` not in "
+                        "(select max(`id`) from `users` group by `username`)"
+                    )
+                    cur.execute(
+                        f"create unique index `{self.INDEX_NAME}` on `users` (`username`)"
+                    )
+                except Exception:
+                    cur.execute("rollback")
+                    raise
+                cur.execute("commit")
+                self._unique_index = True
+
+        if self._has_table("acls") and self.ACL_INDEX_NAME not in self._indexes("acls"):
+            changes["acl_index_created"] = self.ACL_INDEX_NAME
+            if not test:
+                cur.execute("begin immediate")
+                try:
+                    cur.execute(
+                        "delete from `acls` where `id` not in "
+                        "(select max(`id`) from `acls` group by `username`, `topic`)"
+                    )
+                    cur.execute(
+                        f"create unique index `{self.ACL_INDEX_NAME}` "
+                        "on `acls` (`username`, `topic`)"
+                    )
+                except Exception:
+                    cur.execute("rollback")
+                    raise
+                cur.execute("commit")
+
+        if wal:
+            cur.execute("pragma journal_mode")
+            if cur.fetchone()[0].lower() != "wal":
+                changes["journal_mode"] = "wal"
+                if not test:
+                    cur.execute("pragma journal_mode=wal")
+            if not test:
+                changes.update(self._fix_wal_permissions())
+
+        return changes
+
+    def _fix_wal_permissions(self):
+        changes = {}
+        stat = self.pw_file.stat()
+        for suffix in ("-wal", "-shm"):
+            path = Path(f"{self.pw_file}{suffix}")
+            try:
+                cur = path.stat()
+            except FileNotFoundError:
+                continue
+            if (cur.st_uid, cur.st_gid) != (stat.st_uid, stat.st_gid):
+                try:
+                    os.chown(path, stat.st_uid, stat.st_gid)
+                    changes[str(path)] = "ownership fixed"
+                except PermissionError:
+                    pass
+            mode = stat.st_mode & 0o7777
+            if cur.st_mode & 0o7777 != mode:
+                os.chmod(path, mode)
+                changes[str(path)] = "permissions fixed"
+        return changes
+
+    def _has_table(self, table):
+        cur = self._cur()
+        cur.execute(
+            "select count(*) from `sqlite_master` where `type` = 'table' and `name` = ?",
+            [table],
+        )
+        return bool(cur.fetchone()[0])
+
+    def _indexes(self, table):
+        cur = self._cur()
+        cur.execute(f"pragma index_list(`{table}`)")
+        return [row[1] for row in cur.fetchall()]
+
+    def _has_unique_index(self):
+        if getattr(self, "_unique_index", None) is None:
+            cur = self._cur()
+            cur.execute("pragma index_list(`users`)")
+            unique_indexes = [row[1] for row in cur.fetchall() if row[2]]
+            self._unique_index = False
+            for index in unique_indexes:
+                cur.execute(f"pragma index_info(`{index}`)")
+                if [row[2] for row in cur.fetchall()] == ["username"]:
+                    self._unique_index = True
+                    break
+        return self._unique_index
+
+    def _can_upsert(self):
+        # upsert was added in SQLite 3.24.0 and requires a unique index
+        return sqlite3.sqlite_version_info >= (3, 24, 0) and self._has_unique_index()
+
     def _rm(self, username):
         query = "delete from `users` where `username` = ?"
         cur = self._cur()
@@ -349,5 +1401,11 @@ class SQLiteUserCollection(UserCollection):
                 "Running this function requires sqlite3 library. Make sure it is importable by Salt."
             )
         if not hasattr(self, "connection"):
-            self.connection = sqlite3.connect(self.pw_file, isolation_level=None)
+            self.connection = sqlite3.connect(
+                self.pw_file, isolation_level=None, timeout=30
+            )
+            self.connection.set_trace_callback(self._trace)
         return self.connection.cursor()
+
+    def _trace(self, statement):
+        self.profile.add("sqlite_query")
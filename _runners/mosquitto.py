@@ -0,0 +1,339 @@
+"""
+Salt runner module to precompute Eclipse Mosquitto password hashes on the master.
+
+Hashes are cached in the master cache, keyed by a keyed fingerprint of the
+username, password and the hashing parameters. Hashing the same password of a user
+with the same parameters thus always returns the same hash, which allows minions
+to compare the hashes they receive via ``password_hash_pillar`` by string equality
+instead of running the key derivation function during every run. Users sharing
+a password still get different salts.
+
+The cache can be cleared with ``salt-run cache.flush mosquitto/hashes``.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import secrets
+
+import salt.cache
+import salt.fileclient
+import salt.utils.atomicfile
+import salt.utils.data
+import salt.utils.dictupdate
+import salt.utils.files
+import salt.utils.yaml
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+# __utils__ dunder is deprecated
+import mosquitto
+
+CACHE_BANK = "mosquitto/hashes"
+FINGERPRINT_KEY = "fingerprint_key"
+DEFAULT_PILLAR_KEY = "mosquitto_password_hashes"
+FORMULA_DEFAULTS = "salt://mosquitto/parameters/defaults.yaml"
+
+# mosquitto-go-auth hashing parameters and their configuration keys
+GOAUTH_HASHER_CONFIG = {
+    "pbkdf2": {
+        "iterations": "auth_opt_hasher_iterations",
+        "hmac_hash": "auth_opt_hasher_algorithm",
+        "keylen": "auth_opt_hasher_keylen",
+        "salt_size": "auth_opt_hasher_salt_size",
+    },
+    "bcrypt": {
+        "cost": "auth_opt_hasher_cost",
+    },
+    "argon2id": {
+        "iterations": "auth_opt_hasher_iterations",
+        "memory": "auth_opt_hasher_memory",
+        "parallelism": "auth_opt_hasher_parallelism",
+        "keylen": "auth_opt_hasher_keylen",
+        "salt_size": "auth_opt_hasher_salt_size",
+    },
+}
+
+
+def hash_password(password, goauth=False, hash_opts=None):
+    """
+    Return a cached hash of a password. The hash is only computed
+    the first time a password is hashed with these parameters.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run mosquitto.hash_password hunter1 goauth=true hash_opts='{hasher: argon2id}'
+
+    password
+        The password to hash.
+
+    goauth
+        Whether to generate a mosquitto-go-auth hash. Defaults to false.
+
+    hash_opts
+        Mapping of password hashing parameters to values. See the ``get_pw_hash``
+        function of the ``mosquitto``/``mosquitto_goauth`` execution modules.
+    """
+    return hash_passwords({"_": password}, goauth=goauth, hash_opts=hash_opts)["_"]
+
+
+def hash_passwords(passwords, goauth=False, hash_opts=None, output=None, key=None):
+    """
+    Return cached hashes for a mapping of usernames to passwords.
+    Only passwords that have not been hashed for the user with these
+    parameters before are hashed. Each user gets their own salt,
+    so users sharing a password do not share a hash.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run mosquitto.hash_passwords '{alice: hunter1, bob: hunter2}' output=/srv/pillar/mosquitto_hashes.sls
+
+    passwords
+        Mapping of usernames to passwords.
+
+    goauth
+        Whether to generate mosquitto-go-auth hashes. Defaults to false.
+
+    hash_opts
+        Mapping of password hashing parameters to values. See ``hash_password``.
+
+    output
+        Write the hashes as a pillar file to this path. It is only rewritten
+        if the hashes changed. Optional.
+
+    key
+        When writing ``output``, the pillar key to nest the hashes under.
+        Defaults to ``mosquitto_password_hashes``.
+    """
+    hash_opts = hash_opts or {}
+    cache = salt.cache.factory(__opts__)
+    fp_key = _fingerprint_key(cache)
+    params = json.dumps({"goauth": bool(goauth), "hash_opts": hash_opts}, sort_keys=True)
+
+    ret = {}
+    for username, password in (passwords or {}).items():
+        if password is None:
+            raise SaltInvocationError(f"Found no password for user {username}.")
+        # include the username, users sharing a password must not share a salt
+        fingerprint = hmac.new(
+            fp_key,
+            b"\0".join(
+                [params.encode(), str(username).encode(), str(password).encode()]
+            ),
+            hashlib.sha256,
+        ).hexdigest()
+        pw_hash = cache.fetch(CACHE_BANK, fingerprint)
+        if not pw_hash:
+            pw_hash = _hash(str(password), goauth, hash_opts)
+            cache.store(CACHE_BANK, fingerprint, pw_hash)
+        ret[str(username)] = pw_hash
+
+    if output is not None:
+        _write_pillar(output, {key or DEFAULT_PILLAR_KEY: ret})
+    return ret
+
+
+def hash_pillar(
+    tgt,
+    output,
+    tgt_type="glob",
+    key=DEFAULT_PILLAR_KEY,
+    hash_opts=None,
+    saltenv=None,
+):
+    """
+    Compile the pillar of the targeted minions, hash the passwords of the users
+    in ``mosquitto:users:present`` (``password`` or ``password_pillar``) and write
+    the hashes as a pillar file mapping usernames to hashes under ``key``.
+    Assign it to the minions and reference the hashes with
+    ``password_hash_pillar: mosquitto_password_hashes:<username>``.
+
+    The hashing parameters are determined like ``post-map.jinja`` does:
+    From ``mosquitto:users:hash_opts`` and, for mosquitto-go-auth,
+    the ``auth_opt_hasher*`` configuration in the pillar, merged over the
+    container variant's ``default_config`` from the formula's ``defaults.yaml``.
+    Calibrated parameters (``tuning:hash_calibration``) are taken from the
+    cached grains of the minion.
+    A username needs to have the same password and parameters on all targeted minions.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run mosquitto.hash_pillar 'broker*' /srv/pillar/mosquitto_hashes.sls
+
+    tgt
+        Target minions.
+
+    output
+        Path of the pillar file to write. It is only rewritten if the hashes changed.
+
+    tgt_type
+        Targeting type. Defaults to ``glob``.
+
+    key
+        The pillar key to nest the hashes under. Defaults to ``mosquitto_password_hashes``.
+
+    hash_opts
+        Override the hashing parameters for all users.
+
+    saltenv
+        The environment to load the formula's ``defaults.yaml`` from.
+        Defaults to ``base``.
+    """
+    minions = __salt__["cache.grains"](tgt=tgt, tgt_type=tgt_type)
+    if not minions:
+        raise CommandExecutionError(f"No minions matched the target '{tgt}'.")
+    defaults = _formula_defaults(saltenv or "base")
+
+    # (goauth, serialized hash_opts) => {username: password}
+    batches = {}
+    # username => (password, goauth, hash_opts), to detect conflicts
+    seen = {}
+    for minion in sorted(minions):
+        pillar = __salt__["pillar.show_pillar"](minion)
+        mosq = pillar.get("mosquitto") or {}
+        users = mosq.get("users") or {}
+        goauth = "mosquitto_go_auth" == mosq.get("container_variant")
+        base_opts = _effective_hash_opts(mosq, minions[minion] or {}, defaults)
+
+        for username, confs in (users.get("present") or {}).items():
+            confs = confs or {}
+            password = confs.get("password")
+            if not password and confs.get("password_pillar"):
+                password = salt.utils.data.traverse_dict_and_list(
+                    pillar, confs["password_pillar"]
+                )
+            if password is None:
+                continue
+            user_opts = dict(base_opts)
+            user_opts.update(confs.get("hash_opts") or {})
+            user_opts.update(hash_opts or {})
+
+            wanted = (password, goauth, user_opts)
+            if seen.setdefault(username, wanted) != wanted:
+                raise CommandExecutionError(
+                    f"User {username} has different passwords or hashing parameters "
+                    f"on different minions (at least on {minion})."
+                )
+            batches.setdefault(
+                (goauth, json.dumps(user_opts, sort_keys=True)), {}
+            )[username] = password
+
+    ret = {}
+    for (goauth, batch_opts), passwords in batches.items():
+        ret.update(
+            hash_passwords(passwords, goauth=goauth, hash_opts=json.loads(batch_opts))
+        )
+    _write_pillar(output, {key: ret})
+    return {"minions": sorted(minions), "users": sorted(ret), "output": output}
+
+
+def _hash(password, goauth, hash_opts):
+    hash_opts = dict(hash_opts)
+    try:
+        if goauth:
+            return mosquitto.MosquittoGoauthHasher.from_password(
+                password, **hash_opts
+            ).to_string()
+        return mosquitto.MosquittoPassword.from_password(
+            password,
+            algo="pbkdf2" if hash_opts.pop("pbkdf2", True) else "sha512",
+            **hash_opts,
+        ).to_string()
+    except (TypeError, ValueError) as e:
+        raise SaltInvocationError(f"Invalid hashing parameters: {e}")
+
+
+def _effective_hash_opts(mosq, grains, defaults):
+    """
+    Mirror ``post-map.jinja``. mosquitto-go-auth reads the hashing parameters
+    from its configuration, which is merged over the variant's default configuration.
+    Calibrated parameters apply to settings the pillar does not configure.
+    """
+    users = mosq.get("users") or {}
+    configured = mosq.get("config") or {}
+    calibration = None
+    if (mosq.get("tuning") or {}).get("hash_calibration"):
+        calibration = grains.get("mosquitto_hash_calibration")
+
+    if "mosquitto_go_auth" != mosq.get("container_variant"):
+        hash_opts = {}
+        if calibration:
+            hash_opts = {"pbkdf2": True, "iterations": calibration["iterations"]}
+        hash_opts.update(users.get("hash_opts") or {})
+        return hash_opts
+
+    variants = (defaults.get("lookup") or {}).get("container_variants") or {}
+    variants = salt.utils.dictupdate.merge(
+        variants, ((mosq.get("lookup") or {}).get("container_variants") or {})
+    )
+    variant = variants.get("mosquitto_go_auth") or {}
+    config = dict(variant.get("default_config") or {})
+    config.update(configured)
+
+    hasher = config.get("auth_opt_hasher", "pbkdf2")
+    if calibration and "pbkdf2" == hasher:
+        for config_key, val in (
+            ("auth_opt_hasher_iterations", calibration["iterations"]),
+            ("auth_opt_hasher_algorithm", calibration["hmac_hash"]),
+            ("auth_opt_hasher_keylen", calibration["keylen"]),
+        ):
+            if config_key not in configured:
+                config[config_key] = val
+
+    hash_opts = {"hasher": hasher}
+    for param, config_key in GOAUTH_HASHER_CONFIG.get(hasher, {}).items():
+        if config_key in config:
+            hash_opts[param] = config[config_key]
+    hash_opts.update(users.get("hash_opts") or {})
+    return hash_opts
+
+
+def _fingerprint_key(cache):
+    """
+    Fingerprints are HMACs with a random key, so the cache
+    does not contain plain digests of the passwords.
+    """
+    fp_key = cache.fetch(CACHE_BANK, FINGERPRINT_KEY)
+    if not fp_key:
+        fp_key = secrets.token_hex(32)
+        cache.store(CACHE_BANK, FINGERPRINT_KEY, fp_key)
+    return fp_key.encode()
+
+
+def _formula_defaults(saltenv):
+    """
+    Load the formula's ``defaults.yaml`` from the master fileserver.
+    """
+    with salt.fileclient.FSClient(__opts__) as client:
+        path = client.cache_file(FORMULA_DEFAULTS, saltenv)
+    if not path:
+        raise CommandExecutionError(
+            f"Could not find {FORMULA_DEFAULTS} in saltenv {saltenv}."
+        )
+    with salt.utils.files.fopen(path, encoding="utf-8") as f:
+        return (salt.utils.yaml.safe_load(f) or {}).get("values") or {}
+
+
+def _write_pillar(path, data):
+    contents = (
+        "# Generated by salt-run mosquitto.hash_pillar/hash_passwords, do not edit.\n"
+        + salt.utils.yaml.safe_dump(data, default_flow_style=False)
+    )
+    exists = True
+    try:
+        with open(path, encoding="utf-8") as f:
+            if f.read() == contents:
+                return False
+    except FileNotFoundError:
+        exists = False
+    with salt.utils.atomicfile.atomic_open(path, "w") as f:
+        f.write(contents)
+    if not exists:
+        os.chmod(path, 0o600)
+    return True
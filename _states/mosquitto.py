@@ -2,11 +2,37 @@
 Salt state module to manage Eclipse Mosquitto installations.
 """
 
+import functools
+
 from salt.exceptions import CommandExecutionError, SaltInvocationError
 
+# __utils__ dunder is deprecated
+import mosquitto as mosquittoutil
+
 MOSQUITTO_DEFAULT_PW_PATH = "/etc/mosquitto/passwd"
 
 
+def _profiled(func):
+    """
+    If profiling is enabled, attach the wall time and call counts per phase
+    spent in this state to its return as ``profile``.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = mosquittoutil.profiler(__context__, __opts__)
+        if profile is mosquittoutil.NULL_PROFILE:
+            return func(*args, **kwargs)
+        snapshot = profile.snapshot()
+        with profile.phase("state"):
+            ret = func(*args, **kwargs)
+        ret["profile"] = profile.since(snapshot)
+        return ret
+
+    return wrapper
+
+
+@_profiled
 def user_present(
     name,
     password=None,
@@ -15,6 +41,9 @@ def user_present(
     pw_file=MOSQUITTO_DEFAULT_PW_PATH,
     goauth=False,
     hash_opts=None,
+    rehash=False,
+    password_hash=None,
+    password_hash_pillar=None,
 ):
     """
     Make sure a user is present. Optionally make sure the password matches.
@@ -49,21 +78,45 @@ def user_present(
         iterations: 101
 
         For mosquitto-go-auth, those are:
-        iterations: 100000
-        hmac_hash: sha512
-        keylen: 32
-        salt_size: 16
+        hasher: pbkdf2 (or bcrypt, argon2id)
+        iterations: 100000 (pbkdf2), 3 (argon2id)
+        hmac_hash: sha512 (pbkdf2)
+        keylen: 32 (pbkdf2, argon2id)
+        salt_size: 16 (pbkdf2, argon2id)
+        cost: 10 (bcrypt)
+        memory: 4096 (argon2id)
+        parallelism: 2 (argon2id)
+
+        Existing hashes are verified with the hasher they were generated with.
 
         For parameter descriptions, see the relevant execution module's documentation.
+
+    rehash
+        If the password matches, but its hash was generated with different parameters
+        than ``hash_opts``, hash it again. This allows to migrate to calibrated
+        parameters. Requires ``manage_password``. Defaults to false.
+
+    password_hash
+        The precomputed hash the user's password should have, e.g. generated
+        by the ``mosquitto`` runner. It is compared to the stored hash by string
+        equality, so no key derivation is necessary. Takes precedence over
+        ``password``/``password_pillar``.
+
+    password_hash_pillar
+        If password_hash is unspecified, the pillar where to look up the user's password hash.
+        If it does not exist, falls back to ``password``/``password_pillar``.
     """
     ret = {"name": name, "result": True, "comment": "", "changes": {}}
 
-    password = password or __salt__["pillar.get"](password_pillar)
+    if password_hash is None and password_hash_pillar:
+        password_hash = __salt__["pillar.get"](password_hash_pillar, None)
+    if password_hash is None:
+        password = password or __salt__["pillar.get"](password_pillar)
     update = False
     hash_opts = hash_opts or {}
     mosquitto = "mosquitto" if not goauth else "mosquitto_goauth"
 
-    if password is None:
+    if password is None and password_hash is None:
         ret["result"] = False
         ret[
             "comment"
@@ -77,8 +130,15 @@ def user_present(
                     "comment"
                 ] = f"User {name} already exists. The password was not checked."
                 return ret
-            if __salt__[f"{mosquitto}.check_password"](
+            if password_hash is not None:
+                if _get_stored_hash(mosquitto, name, pw_file) == password_hash:
+                    ret["comment"] = f"The password hash for existing user {name} matches."
+                    return ret
+            elif __salt__[f"{mosquitto}.check_password"](
                 password, username=name, pw_file=pw_file
+            ) and not (
+                rehash
+                and _needs_rehash(mosquitto, name, pw_file=pw_file, hash_opts=hash_opts)
             ):
                 ret["comment"] = f"The password for existing user {name} matches."
                 return ret
@@ -92,7 +152,9 @@ def user_present(
             ret["changes"] = {"updated" if update else "added": name}
             return ret
 
-        pw_hash = __salt__[f"{mosquitto}.get_pw_hash"](password, **hash_opts)
+        pw_hash = password_hash or __salt__[f"{mosquitto}.get_pw_hash"](
+            password, **hash_opts
+        )
 
         if __salt__[f"{mosquitto}.add_user"](
             name,
@@ -105,10 +167,7 @@ def user_present(
             )
             ret["changes"] = {"updated" if update else "added": name}
         else:
-            ret["result"] = False
-            ret[
-                "comment"
-            ] = "Something went wrong. This should not happen at all since errors are raised."
+            ret["comment"] = f"User {name} is already in the correct state."
 
     except (CommandExecutionError, SaltInvocationError) as e:
         ret["result"] = False
@@ -118,6 +177,7 @@ def user_present(
     return ret
 
 
+@_profiled
 def user_absent(name, pw_file=MOSQUITTO_DEFAULT_PW_PATH, goauth=False):
     """
     Make sure a user is absent.
@@ -161,3 +221,557 @@ def user_absent(name, pw_file=MOSQUITTO_DEFAULT_PW_PATH, goauth=False):
         return ret
 
     return ret
+
+
+@_profiled
+def users_managed(
+    name,
+    present=None,
+    absent=None,
+    remove_unlisted=False,
+    goauth=False,
+    hash_opts=None,
+    workers=None,
+    rehash=False,
+):
+    """
+    Make sure a set of users is present and another one absent.
+    In contrast to ``user_present``/``user_absent``, the backend is read
+    a single time, the changes are computed in memory and applied
+    in a single write (file) or transaction (SQLite).
+
+    name
+        Path to the file that contains usernames and passwords.
+        For goauth, SQLite databases will be autodetected and treated as such.
+
+    present
+        Mapping of usernames to configuration values. Valid configuration values
+        are ``password``, ``password_pillar``, ``password_hash``, ``password_hash_pillar``,
+        ``manage_password`` and ``hash_opts``. See ``user_present`` for their descriptions.
+
+    absent
+        List of usernames that should be absent.
+
+    remove_unlisted
+        Remove all users that are not listed in ``present``. Defaults to false.
+
+    goauth
+        Whether to use mosquitto-go-auth format and defaults. This allows different backends.
+        Currently, only the file and SQLite backends can be managed by this module.
+        Defaults to false.
+
+    hash_opts
+        Mapping of password hashing parameters to values, used for all users.
+        Per-user ``hash_opts`` take precedence. See ``user_present`` for details.
+
+    workers
+        Number of parallel workers used to check and hash passwords.
+        Defaults to the number of CPU cores.
+
+    rehash
+        Hash matching passwords again if their hash was generated with different
+        parameters than the effective ``hash_opts``. Defaults to false.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    present = present or {}
+    absent = set(absent or [])
+    hash_opts = hash_opts or {}
+    mosquitto = "mosquitto" if not goauth else "mosquitto_goauth"
+
+    conflicting = absent.intersection(present)
+    if conflicting:
+        ret["result"] = False
+        ret["comment"] = "Users cannot be both present and absent: " + ", ".join(
+            sorted(conflicting)
+        )
+        return ret
+
+    try:
+        current = __salt__[f"{mosquitto}.list_users"](include_pass=True, pw_file=name)
+        added, updated, missing_pw = [], [], []
+        # username => (password, hash_opts)
+        to_check, to_hash = {}, {}
+        # username => precomputed hash, compared by string equality
+        precomputed = {}
+
+        for user, confs in present.items():
+            confs = confs or {}
+            pw_hash = confs.get("password_hash")
+            if pw_hash is None and confs.get("password_hash_pillar"):
+                pw_hash = __salt__["pillar.get"](confs["password_hash_pillar"], None)
+            if pw_hash is not None:
+                if user not in current:
+                    added.append(user)
+                    precomputed[user] = pw_hash
+                elif confs.get("manage_password", True) and current[user] != pw_hash:
+                    updated.append(user)
+                    precomputed[user] = pw_hash
+                continue
+
+            password = confs.get("password")
+            if not password and confs.get("password_pillar"):
+                password = __salt__["pillar.get"](confs["password_pillar"])
+
+            if password is None:
+                missing_pw.append(user)
+                continue
+
+            user_hash_opts = hash_opts.copy()
+            user_hash_opts.update(confs.get("hash_opts") or {})
+
+            if user not in current:
+                added.append(user)
+                to_hash[user] = (password, user_hash_opts)
+            elif confs.get("manage_password", True):
+                to_check[user] = (password, user_hash_opts)
+
+        if to_check:
+            matches = __salt__[f"{mosquitto}.check_passwords"](
+                [(password, current[user]) for user, (password, _) in to_check.items()],
+                workers=workers,
+            )
+            for user, match in zip(to_check, matches):
+                if not match or (
+                    rehash
+                    and __salt__[f"{mosquitto}.needs_rehash"](
+                        current[user], **to_check[user][1]
+                    )
+                ):
+                    updated.append(user)
+                    to_hash[user] = to_check[user]
+
+        wanted = dict(precomputed)
+        if to_hash and not __opts__["test"]:
+            wanted.update(_hash_passwords(mosquitto, to_hash, workers))
+
+        removed = [
+            user
+            for user in current
+            if user in absent or (remove_unlisted and user not in present)
+        ]
+
+        changes = {}
+        for change, users in (
+            ("added", added),
+            ("updated", updated),
+            ("removed", removed),
+        ):
+            if users:
+                changes[change] = sorted(users)
+
+        if missing_pw:
+            ret["result"] = False
+            ret["comment"] = (
+                "Found no password for users: "
+                + ", ".join(sorted(missing_pw))
+                + ". Make sure password or password_pillar is specified. "
+                "If password_pillar is used, make sure the pillar value exists on this minion. "
+            )
+
+        if not changes:
+            ret["comment"] += "All users are in the correct state."
+            return ret
+
+        if __opts__["test"]:
+            ret["result"] = None if ret["result"] else False
+            ret["comment"] += "Users would have been changed."
+            ret["changes"] = changes
+            return ret
+
+        if __salt__[f"{mosquitto}.set_users"](wanted, remove=removed, pw_file=name):
+            ret["comment"] += "Users have been changed."
+            ret["changes"] = changes
+        else:
+            ret["comment"] += "The backend already contained the wanted users."
+
+    except (CommandExecutionError, SaltInvocationError) as e:
+        ret["result"] = False
+        ret["comment"] = str(e)
+        return ret
+
+    return ret
+
+
+def users_migrated(name, source, batch_size=1000, verify=True):
+    """
+    Make sure all users of a mosquitto-go-auth backend exist in another one
+    with the same password hashes, e.g. to move from a password file to a
+    SQLite database. Hashes are copied as they are. Users that only exist
+    in the target are kept.
+
+    SQLite targets are written in one transaction per batch and an interrupted
+    migration resumes from its last committed batch. In test mode, the users
+    that would be added or updated are reported.
+
+    name
+        Path to the database/file to migrate the users to. Needs to exist.
+
+    source
+        Path to the database/file to migrate the users from.
+
+    batch_size
+        Number of users per batch. Defaults to 1000.
+
+    verify
+        After the migration, check that all users of the source have
+        the same hash in the target. Defaults to true.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    try:
+        res = __salt__["mosquitto_goauth.migrate_users"](
+            source,
+            name,
+            batch_size=batch_size,
+            verify=verify,
+            test=__opts__["test"],
+        )
+    except (CommandExecutionError, SaltInvocationError) as e:
+        ret["result"] = False
+        ret["comment"] = str(e)
+        return ret
+
+    changes = {key: res[key] for key in ("added", "updated") if res[key]}
+    if res["resumed"]:
+        changes["resumed"] = res["resumed"]
+
+    if not changes:
+        ret["comment"] = f"All users of {source} are already present."
+    elif __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = f"Users would have been migrated from {source}."
+        ret["changes"] = changes
+    else:
+        ret["comment"] = f"Users have been migrated from {source}."
+        ret["changes"] = changes
+
+    if res.get("verified") is not None:
+        ret["comment"] += f" Verified {res['verified']} users."
+    return ret
+
+
+def config_diffed(name, action="restart", config_state=None):
+    """
+    Compare the effective configuration with the snapshot of the configuration
+    the broker was last started or reloaded with. Reports changes only
+    if applying them requires ``action``, which allows to ``watch`` this state
+    to restart or reload the broker only when necessary.
+    Comments, whitespace and the order of lines are ignored.
+    The snapshot is recorded by ``config_snapshot_updated``.
+
+    Without a snapshot, all configuration is assumed to require a restart,
+    unless ``config_state`` reported no changes during this run. In that case,
+    the broker is assumed to run with the current configuration, which is
+    recorded as the initial snapshot.
+
+    name
+        Path to the configuration file.
+
+    action
+        Either ``restart`` or ``reload``. Defaults to ``restart``.
+        When ``restart`` is required, changes are not reported for ``reload``.
+
+    config_state
+        ID of the state that manages the configuration file. Optional.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    if action not in ["reload", "restart"]:
+        ret["result"] = False
+        ret["comment"] = f"Invalid action '{action}'. Valid: reload, restart."
+        return ret
+
+    try:
+        snapshot = __salt__["mosquitto.config_snapshot"](name)
+        if snapshot is None and config_state and _state_unchanged(config_state):
+            if not __opts__["test"]:
+                __salt__["mosquitto.config_snapshot"](name, update=True)
+            ret["comment"] = (
+                "The configuration did not change during this run, "
+                "recorded it as the initial snapshot."
+            )
+            return ret
+        if snapshot is None:
+            diff = {"action": "restart", "changes": []}
+        else:
+            diff = __salt__["mosquitto.diff_config"](snapshot, name)
+    except (CommandExecutionError, SaltInvocationError) as e:
+        ret["result"] = False
+        ret["comment"] = str(e)
+        return ret
+
+    if diff["action"] != action:
+        ret["comment"] = (
+            "The configuration did not change effectively."
+            if "none" == diff["action"]
+            else f"The configuration changes require a {diff['action']}, not a {action}."
+        )
+        return ret
+
+    changed = sorted(
+        {
+            f"{change['scope']}: {change['key']}" if change["key"] else change["scope"]
+            for change in diff["changes"]
+        }
+    ) or ["no snapshot"]
+    ret["changes"] = {action: changed}
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = f"The configuration changes would require a {action}."
+    else:
+        ret["comment"] = f"The configuration changes require a {action}."
+    return ret
+
+
+def config_snapshot_updated(name):
+    """
+    Record the configuration as the snapshot ``config_diffed`` compares against.
+    This needs to run after the broker has been restarted or reloaded
+    successfully (``require`` the service states), otherwise pending changes
+    would not be applied during the next run.
+
+    name
+        Path to the configuration file.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    try:
+        snapshot = __salt__["mosquitto.config_snapshot"](name)
+        if snapshot == __salt__["mosquitto.parse_config"](name):
+            ret["comment"] = "The configuration snapshot is up to date."
+            return ret
+        if not __opts__["test"]:
+            __salt__["mosquitto.config_snapshot"](name, update=True)
+    except (CommandExecutionError, SaltInvocationError) as e:
+        ret["result"] = False
+        ret["comment"] = str(e)
+        return ret
+
+    ret["changes"] = {"snapshot": "created" if snapshot is None else "updated"}
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = "The configuration snapshot would have been updated."
+    else:
+        ret["comment"] = "The configuration snapshot has been updated."
+    return ret
+
+
+def profile_started(name):
+    """
+    Start recording the wall time and call counts per phase (read, verify, hash,
+    write, sqlite_query) for the rest of the run. States of this module attach
+    their share to their return as ``profile``. Order this first.
+
+    name
+        Irrelevant.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    __salt__["mosquitto.profile_start"]()
+    ret["comment"] = "Started profiling."
+    return ret
+
+
+def profile_reported(name, tag="salt/mosquitto/profile"):
+    """
+    Send the wall time and call counts per phase recorded during this run
+    as an event to the master. Order this last.
+
+    name
+        Irrelevant.
+
+    tag
+        The event tag. Defaults to ``salt/mosquitto/profile``.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    if __opts__["test"]:
+        ret["comment"] = "The profile would have been reported."
+        ret["profile"] = __salt__["mosquitto.profile_report"]()
+        return ret
+
+    ret["profile"] = __salt__["mosquitto.profile_report"](fire_event=True, tag=tag)
+    ret["comment"] = f"Reported the profile as {tag}."
+    return ret
+
+
+def reloaded(name, pid=None, pidfile=None, user=None):
+    """
+    Make a running Mosquitto broker reload its configuration, password and ACL
+    files (SIGHUP) when a watched state reports changes. In contrast to a
+    restart, this does not drop client connections. Without changes
+    in watched states, this state does nothing.
+
+    name
+        The name of the container the broker runs in.
+
+    pid
+        Signal the process with this PID directly instead of the container.
+
+    pidfile
+        Read the PID of the process to signal from this file instead.
+
+    user
+        For rootless containers, the user account the container runs under.
+    """
+    return {
+        "name": name,
+        "result": True,
+        "comment": "The broker is only reloaded when a watched state reports changes.",
+        "changes": {},
+    }
+
+
+def mod_watch(name, sfun=None, **kwargs):
+    """
+    Reload the broker when a state watched by ``reloaded`` reports changes.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    if "reloaded" != sfun:
+        ret["result"] = False
+        ret["comment"] = f"watch requisite is not implemented for {sfun}"
+        return ret
+
+    if __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = f"The broker in {name} would have been reloaded."
+        ret["changes"] = {"reloaded": name}
+        return ret
+
+    try:
+        __salt__["mosquitto.reload"](
+            name,
+            pid=kwargs.get("pid"),
+            pidfile=kwargs.get("pidfile"),
+            user=kwargs.get("user"),
+        )
+    except (CommandExecutionError, SaltInvocationError) as e:
+        ret["result"] = False
+        ret["comment"] = str(e)
+        return ret
+
+    ret["comment"] = f"The broker in {name} has been reloaded."
+    ret["changes"] = {"reloaded": name}
+    return ret
+
+
+def sqlite_schema_migrated(name, wal=True):
+    """
+    Make sure a mosquitto-go-auth SQLite user database has a unique index
+    on ``users.username``. Duplicate usernames are removed, keeping the most
+    recent row. Optionally make sure the database uses the WAL journal mode.
+
+    name
+        Path to the SQLite database that contains usernames and passwords.
+
+    wal
+        Make sure the WAL journal mode is enabled. This allows the broker to
+        read the database while it is written. Defaults to true.
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    try:
+        changes = __salt__["mosquitto_goauth.migrate_schema"](
+            name, wal=wal, test=__opts__["test"]
+        )
+    except (CommandExecutionError, SaltInvocationError) as e:
+        ret["result"] = False
+        ret["comment"] = str(e)
+        return ret
+
+    if not changes:
+        ret["comment"] = "The database schema is already up to date."
+    elif __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = "The database schema would have been migrated."
+        ret["changes"] = changes
+    else:
+        ret["comment"] = "The database schema has been migrated."
+        ret["changes"] = changes
+
+    return ret
+
+
+def acls_synced(name, acl=None):
+    """
+    Make sure the ``acls`` table of a mosquitto-go-auth SQLite database contains
+    exactly the user rules of an ACL. Only differing rows are inserted, updated
+    or deleted. Anonymous and pattern rules as well as users with deny rules
+    cannot be represented in the table and are skipped, they need to stay
+    in the ACL file (see ``mosquitto_goauth.split_acl``).
+
+    name
+        Path to the SQLite database that contains the ``acls`` table.
+
+    acl
+        Mapping in the format of the formula's ``acl`` configuration
+        (``anonymous``, ``user``, ``pattern``).
+    """
+    ret = {"name": name, "result": True, "comment": "", "changes": {}}
+
+    try:
+        changes = __salt__["mosquitto_goauth.sync_acls"](
+            name, acl=acl, test=__opts__["test"]
+        )
+    except (CommandExecutionError, SaltInvocationError) as e:
+        ret["result"] = False
+        ret["comment"] = str(e)
+        return ret
+
+    if not changes:
+        ret["comment"] = "The ACL table is already in sync."
+    elif __opts__["test"]:
+        ret["result"] = None
+        ret["comment"] = "The ACL table would have been synced."
+        ret["changes"] = changes
+    else:
+        ret["comment"] = "The ACL table has been synced."
+        ret["changes"] = changes
+
+    return ret
+
+
+def _state_unchanged(state_id):
+    """
+    Check whether the state with this ID ran during this run without
+    reporting changes.
+    """
+    results = [
+        result
+        for tag, result in __running__.items()
+        if tag.split("_|-")[1:2] == [state_id]
+    ]
+    return bool(results) and not any(result["changes"] for result in results)
+
+
+def _hash_passwords(mosquitto, to_hash, workers=None):
+    """
+    Hash passwords in bulk, one batch per distinct set of hashing options.
+    ``to_hash`` maps usernames to (password, hash_opts) tuples.
+    """
+    batches = {}
+    for user, (password, user_hash_opts) in to_hash.items():
+        batches.setdefault(tuple(sorted(user_hash_opts.items())), []).append(
+            (user, password)
+        )
+
+    ret = {}
+    for batch_opts, batch in batches.items():
+        hashes = __salt__[f"{mosquitto}.get_pw_hashes"](
+            [password for _, password in batch], workers=workers, **dict(batch_opts)
+        )
+        ret.update(zip((user for user, _ in batch), hashes))
+    return ret
+
+
+def _get_stored_hash(mosquitto, name, pw_file):
+    return __salt__[f"{mosquitto}.get_stored_hash"](name, pw_file=pw_file)
+
+
+def _needs_rehash(mosquitto, name, pw_file, hash_opts):
+    pw_hash = _get_stored_hash(mosquitto, name, pw_file)
+    if pw_hash is None:
+        return False
+    return __salt__[f"{mosquitto}.needs_rehash"](pw_hash, **hash_opts)
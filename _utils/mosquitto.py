@@ -5,17 +5,199 @@ Helper for Mosquitto password modules.
 import base64
 import hashlib
 import hmac
+import itertools
+import mmap
+import os
+import re
 import secrets
+import statistics
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
+try:
+    import fcntl
+
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+try:
+    import bcrypt
+
+    HAS_BCRYPT = True
+except ImportError:
+    HAS_BCRYPT = False
+
+try:
+    from argon2.low_level import Type as Argon2Type
+    from argon2.low_level import hash_secret_raw
+
+    HAS_ARGON2 = True
+except ImportError:
+    HAS_ARGON2 = False
+
 from salt.exceptions import CommandExecutionError
 
 
+# Parsed password files, keyed by absolute path. Entries are validated
+# against (inode, size, mtime_ns) on every access.
+_PW_FILE_CACHE = OrderedDict()
+_PW_FILE_CACHE_SIZE = 8
+# Stat keys of password files known to be sorted by username
+_PW_FILE_SORTED = {}
+
+
 def read_pw_file(pw_file, include_pass=False):
-    pw = _check_pw_file(pw_file)
-    ret = []
+    users = _parse_pw_file(pw_file)
+
+    if include_pass:
+        return dict(users)
+    return list(users)
+
+
+def iter_pw_file(pw_file, include_pass=False, prefix=None, limit=None, offset=0):
+    """
+    Iterate over the users in a password file in file order, reading it
+    line by line instead of loading it as a whole. Yields usernames or
+    (username, hash) tuples, optionally filtered by ``prefix`` and
+    paginated by ``offset``/``limit``.
+    """
+    entries = _iter_pw_entries(pw_file, prefix)
+    stop = None if limit is None else offset + limit
+    for user, pw_hash in itertools.islice(entries, offset, stop):
+        yield (user, pw_hash) if include_pass else user
+
+
+def _iter_pw_entries(pw_file, prefix=None):
+    key = os.path.abspath(pw_file)
+
+    try:
+        f = open(key, "rb")
+    except FileNotFoundError:
+        raise CommandExecutionError(f"Password file {pw_file} does not exist.")
+
+    with f:
+        # sorted files can stop reading after the last match
+        stat = os.fstat(f.fileno())
+        is_sorted = _PW_FILE_SORTED.get(key) == _stat_key(stat)
+
+        for line in f:
+            line = line.rstrip(b"\r\n")
+            if not line:
+                continue
+
+            parts = line.decode().split(":")
+            if not 2 == len(parts):
+                raise CommandExecutionError(f"Could not parse {pw_file}.")
+            user, userpass = parts
+            if prefix and not user.startswith(prefix):
+                if is_sorted and user > prefix:
+                    return
+                continue
+            yield user, userpass
+
+
+def read_pw_entry(pw_file, username):
+    """
+    Return the password hash of a single user or None if it does not exist.
+
+    If the file has not been parsed already, it is memory-mapped and
+    binary-searched instead of being loaded, since ``write_pw_file`` keeps
+    it sorted. A miss falls back to a linear scan unless the file is known
+    to be sorted, since it might have been modified by hand or ``mosquitto_passwd``.
+    """
+    key = os.path.abspath(pw_file)
+
+    try:
+        f = open(key, "rb")
+    except FileNotFoundError:
+        raise CommandExecutionError(f"Password file {pw_file} does not exist.")
+
+    with f:
+        stat = os.fstat(f.fileno())
+        cached = _PW_FILE_CACHE.get(key)
+        if cached is not None and cached[0] == _stat_key(stat):
+            return cached[1].get(username)
+        if not stat.st_size:
+            return None
+
+        user = str(username).encode()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pw_hash = _bisect_pw_file(mm, user)
+            if pw_hash is None and _PW_FILE_SORTED.get(key) != _stat_key(stat):
+                pw_hash = _scan_pw_file(mm, user)
+
+    if pw_hash is None:
+        return None
+    return pw_hash.rstrip(b"\r").decode()
+
+
+def _bisect_pw_file(mm, user):
+    lo, hi = 0, len(mm)
 
-    for line in pw.read_text().splitlines():
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = mm.rfind(b"\n", 0, mid) + 1
+        end = mm.find(b"\n", start)
+        if end == -1:
+            end = len(mm)
+        current, _, pw_hash = mm[start:end].partition(b":")
+        if current == user:
+            return pw_hash
+        if current < user:
+            lo = end + 1
+        else:
+            hi = start
+    return None
+
+
+def _scan_pw_file(mm, user):
+    needle = user + b":"
+
+    if mm[: len(needle)] == needle:
+        start = 0
+    else:
+        start = mm.find(b"\n" + needle)
+        if start == -1:
+            return None
+        start += 1
+
+    end = mm.find(b"\n", start)
+    if end == -1:
+        end = len(mm)
+    return mm[start + len(needle) : end]
+
+
+def _mark_sorted(key, stat):
+    _PW_FILE_SORTED[key] = _stat_key(stat)
+    while len(_PW_FILE_SORTED) > _PW_FILE_CACHE_SIZE:
+        _PW_FILE_SORTED.pop(next(iter(_PW_FILE_SORTED)))
+
+
+def _parse_pw_file(pw_file):
+    """
+    Return the parsed password file as a mapping of usernames to hashes.
+    The result is shared between calls and must not be modified.
+    """
+    key = os.path.abspath(pw_file)
+
+    try:
+        with open(key, "rb") as f:
+            stat = os.fstat(f.fileno())
+            cached = _PW_FILE_CACHE.get(key)
+            if cached is not None and cached[0] == _stat_key(stat):
+                _PW_FILE_CACHE.move_to_end(key)
+                return cached[1]
+            contents = f.read().decode()
+    except FileNotFoundError:
+        raise CommandExecutionError(f"Password file {pw_file} does not exist.")
+
+    users = {}
+    for line in contents.splitlines():
         if not line:
             continue
 
@@ -23,14 +205,24 @@ def read_pw_file(pw_file, include_pass=False):
         if not 2 == len(parts):
             raise CommandExecutionError(f"Could not parse {pw_file}.")
         user, userpass = parts
-        if include_pass:
-            ret.append((user, userpass))
-        else:
-            ret.append(user)
+        users[user] = userpass
 
-    if include_pass:
-        return dict(ret)
-    return ret
+    _cache_pw_file(key, stat, users)
+    usernames = list(users)
+    if all(prev < cur for prev, cur in zip(usernames, usernames[1:])):
+        _mark_sorted(key, stat)
+    return users
+
+
+def _cache_pw_file(key, stat, users):
+    _PW_FILE_CACHE[key] = (_stat_key(stat), users)
+    _PW_FILE_CACHE.move_to_end(key)
+    while len(_PW_FILE_CACHE) > _PW_FILE_CACHE_SIZE:
+        _PW_FILE_CACHE.popitem(last=False)
+
+
+def _stat_key(stat):
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
 
 
 def _check_pw_file(pw_file):
@@ -42,11 +234,139 @@ def _check_pw_file(pw_file):
 
 
 def write_pw_file(pw_file, data):
+    """
+    Atomically replace the password file with the users in ``data``.
+    The new contents are written to a temporary file in the same directory,
+    which inherits ownership, mode and SELinux context of the current one,
+    and then renamed over it. Readers never observe a partial file.
+
+    If the file already has the exact same contents, it is not touched at all.
+    Returns whether the file was changed.
+    """
     pw = _check_pw_file(pw_file)
+    contents = "".join(f"{user}:{data[user]}\n" for user in sorted(data)).encode()
+    changed = False
+
+    with _lock_pw_file(pw):
+        stat = pw.stat()
+        if stat.st_size != len(contents) or pw.read_bytes() != contents:
+            changed = True
+            _replace_file(pw, contents, stat)
+
+        key, stat = os.path.abspath(pw), os.stat(pw)
+    _cache_pw_file(key, stat, {str(user): data[user] for user in sorted(data)})
+    _mark_sorted(key, stat)
+    return changed
+
 
-    with open(pw, "w") as f:
-        for user in sorted(data):
-            f.write(f"{user}:{data[user]}\n")
+def _replace_file(path, contents, stat):
+    fd, tmp = tempfile.mkstemp(prefix=f".{path.name}.", dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        _copy_file_attrs(stat, path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def append_pw_file(pw_file, username, pw_hash):
+    """
+    Add a new user by appending a single line to the password file
+    instead of rewriting it. This breaks the sort order the file is kept in
+    unless the username sorts last. ``compact_pw_file`` restores it.
+    """
+    pw = _check_pw_file(pw_file)
+    key = os.path.abspath(pw)
+    username = str(username)
+
+    with _lock_pw_file(pw):
+        if read_pw_entry(pw, username) is not None:
+            raise CommandExecutionError(f"User {username} exists.")
+
+        with open(pw, "a+b") as f:
+            stat = os.fstat(f.fileno())
+            was_sorted = _PW_FILE_SORTED.get(key) == _stat_key(stat)
+            last_user = None
+            prefix = b""
+            if stat.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if mm[-1:] != b"\n":
+                        prefix = b"\n"
+                    # skip trailing blank lines, which do not hold a user
+                    end = len(mm)
+                    while end and mm[end - 1 : end] in (b"\n", b"\r"):
+                        end -= 1
+                    start = mm.rfind(b"\n", 0, end) + 1
+                    last_user = mm[start:end].partition(b":")[0] or None
+            f.write(prefix + f"{username}:{pw_hash}\n".encode())
+            f.flush()
+            os.fsync(f.fileno())
+            new_stat = os.fstat(f.fileno())
+
+    cached = _PW_FILE_CACHE.get(key)
+    if cached is not None and cached[0] == _stat_key(stat):
+        cached[1][username] = pw_hash
+        _cache_pw_file(key, new_stat, cached[1])
+    if was_sorted and (last_user is None or last_user < username.encode()):
+        _mark_sorted(key, new_stat)
+    return True
+
+
+def compact_pw_file(pw_file):
+    """
+    Rewrite the password file sorted by username, e.g. after appending
+    users with ``append_pw_file``. Returns whether the file was changed.
+    """
+    return write_pw_file(pw_file, read_pw_file(pw_file, include_pass=True))
+
+
+@contextmanager
+def _lock_pw_file(pw):
+    """
+    Serialize writers of a password file. Since ``write_pw_file`` renames
+    a new file over the old one, the lock is held on the parent directory.
+    """
+    if not HAS_FCNTL:
+        yield
+        return
+
+    fd = os.open(pw.parent, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _copy_file_attrs(stat, src, dst):
+    os.chmod(dst, stat.st_mode & 0o7777)
+    try:
+        os.chown(dst, stat.st_uid, stat.st_gid)
+    except PermissionError:
+        pass
+    try:
+        os.setxattr(dst, "security.selinux", os.getxattr(src, "security.selinux"))
+    except (AttributeError, OSError):
+        pass
+
+
+def validate_username(username):
+    """
+    Mosquitto usernames must not contain control characters, colons or be longer than 2**16 bytes.
+    """
+
+    username = str(username)
+    if len(username) > 65536:
+        return False
+    if not re.match(r"^((?=[^\x00-\x1F\x7F\u2028\u2029:]).)*$", username):
+        return False
     return True
 
 
@@ -214,6 +534,8 @@ class MosquittoPassword(MosquittoPasswordBase):
 
 
 class MosquittoGoauthPassword(MosquittoPasswordBase):
+    hasher = "pbkdf2"
+
     def __init__(
         self,
         salt,
@@ -269,3 +591,588 @@ class MosquittoGoauthPassword(MosquittoPasswordBase):
             hmac_hash=hmac_hash,
             keylen=keylen,
         )
+
+    @property
+    def params(self):
+        return {
+            "iterations": self.iterations,
+            "hmac_hash": self.hmac_hash,
+            "keylen": self.keylen,
+            "salt_size": len(self.salt),
+        }
+
+
+class MosquittoGoauthBcryptPassword:
+    """
+    bcrypt hashes as generated by mosquitto-go-auth (``$2a$<cost>$<salt+digest>``).
+    The salt is embedded in the hash, only the cost is tunable.
+    """
+
+    hasher = "bcrypt"
+
+    def __init__(self, pw_hash):
+        if not HAS_BCRYPT:
+            raise ValueError("bcrypt hashes require the bcrypt Python library.")
+        self.pw_hash = pw_hash if isinstance(pw_hash, bytes) else pw_hash.encode()
+        try:
+            self.cost = int(self.pw_hash.split(b"$")[2])
+        except (IndexError, ValueError):
+            raise ValueError("Could not parse input string.")
+
+    def check_password(self, password):
+        password = password.encode() if isinstance(password, str) else password
+        if len(password) > 72:
+            return False
+        try:
+            return bcrypt.checkpw(password, self.pw_hash)
+        except ValueError:
+            return False
+
+    def to_string(self):
+        return self.pw_hash.decode()
+
+    @property
+    def params(self):
+        return {"cost": self.cost}
+
+    @staticmethod
+    def from_password(password, cost=10):
+        if not HAS_BCRYPT:
+            raise ValueError("bcrypt hashes require the bcrypt Python library.")
+        password = password.encode() if isinstance(password, str) else password
+        if len(password) > 72:
+            raise ValueError("bcrypt only supports passwords of at most 72 bytes.")
+        if not 4 <= cost <= 31:
+            raise ValueError("bcrypt cost needs to be between 4 and 31.")
+        # Go's bcrypt generates $2a$ hashes
+        return MosquittoGoauthBcryptPassword(
+            bcrypt.hashpw(password, bcrypt.gensalt(cost, prefix=b"2a"))
+        )
+
+    @staticmethod
+    def from_string(s):
+        s = s.split(":")[-1]
+        if not s.startswith(("$2a$", "$2b$", "$2y$")):
+            raise ValueError("Could not parse input string.")
+        return MosquittoGoauthBcryptPassword(s)
+
+
+class MosquittoGoauthArgon2Password:
+    """
+    argon2id hashes as generated by mosquitto-go-auth
+    (``argon2id$v=19$m=<memory>,t=<iterations>,p=<parallelism>$<salt>$<digest>``).
+    Memory is specified in KiB.
+    """
+
+    hasher = "argon2id"
+    version = 19
+
+    def __init__(
+        self,
+        salt,
+        memory=4096,
+        iterations=3,
+        parallelism=2,
+        keylen=32,
+        password=None,
+        digest=None,
+    ):
+        if not HAS_ARGON2:
+            raise ValueError("argon2id hashes require the argon2-cffi Python library.")
+        if iterations < 1 or parallelism < 1:
+            raise ValueError("Need at least one iteration and one lane.")
+        if memory < 8 * parallelism:
+            raise ValueError("Need at least 8 KiB of memory per lane.")
+        if password is None and digest is None:
+            raise ValueError("Need at least either password or digest.")
+        if digest is not None and not isinstance(digest, bytes):
+            raise ValueError("Need digest as raw bytes.")
+
+        self.salt = salt
+        self.memory = memory
+        self.iterations = iterations
+        self.parallelism = parallelism
+        self.keylen = keylen
+        self.password = password if not isinstance(password, str) else password.encode()
+        self.digest = digest
+
+    def check_password(self, password):
+        if not self.digest:
+            self.digest = self._hash()
+        return hmac.compare_digest(self._hash(password), self.digest)
+
+    def to_string(self):
+        if not self.digest:
+            self.digest = self._hash()
+        return "argon2id$v={version}$m={memory},t={iterations},p={parallelism}${salt}${digest}".format(
+            version=self.version,
+            memory=self.memory,
+            iterations=self.iterations,
+            parallelism=self.parallelism,
+            salt=base64.b64encode(self.salt).decode(),
+            digest=base64.b64encode(self.digest).decode(),
+        )
+
+    @property
+    def params(self):
+        return {
+            "memory": self.memory,
+            "iterations": self.iterations,
+            "parallelism": self.parallelism,
+            "keylen": self.keylen,
+            "salt_size": len(self.salt),
+        }
+
+    def _hash(self, password=None):
+        password = password or self.password
+        password = password.encode() if isinstance(password, str) else password
+        return hash_secret_raw(
+            password,
+            self.salt,
+            time_cost=self.iterations,
+            memory_cost=self.memory,
+            parallelism=self.parallelism,
+            hash_len=self.keylen,
+            type=Argon2Type.ID,
+            version=self.version,
+        )
+
+    @staticmethod
+    def from_password(
+        password, memory=4096, iterations=3, parallelism=2, keylen=32, salt_size=16
+    ):
+        salt = secrets.token_bytes(salt_size)
+        return MosquittoGoauthArgon2Password(
+            salt,
+            password=password,
+            memory=memory,
+            iterations=iterations,
+            parallelism=parallelism,
+            keylen=keylen,
+        )
+
+    @staticmethod
+    def from_string(s):
+        s = s.split(":")[-1]
+        parts = s.split("$")
+
+        if not 5 == len(parts) or "argon2id" != parts[0]:
+            raise ValueError("Could not parse input string.")
+
+        _, version, params, salt, digest = parts
+        try:
+            if int(version[2:]) != MosquittoGoauthArgon2Password.version:
+                raise ValueError("Unsupported argon2 version.")
+            params = dict(param.split("=", 1) for param in params.split(","))
+            memory, iterations, parallelism = (
+                int(params["m"]),
+                int(params["t"]),
+                int(params["p"]),
+            )
+        except (KeyError, ValueError):
+            raise ValueError("Could not parse input string.")
+
+        digest = base64.b64decode(digest)
+        return MosquittoGoauthArgon2Password(
+            base64.b64decode(salt),
+            digest=digest,
+            memory=memory,
+            iterations=iterations,
+            parallelism=parallelism,
+            keylen=len(digest),
+        )
+
+
+GOAUTH_HASHERS = {
+    "pbkdf2": MosquittoGoauthPassword,
+    "bcrypt": MosquittoGoauthBcryptPassword,
+    "argon2id": MosquittoGoauthArgon2Password,
+}
+
+
+class MosquittoGoauthHasher:
+    """
+    Dispatches to the mosquitto-go-auth hasher class by name when hashing
+    and by the format of the hash when parsing.
+    """
+
+    @staticmethod
+    def get(hasher):
+        try:
+            return GOAUTH_HASHERS[hasher]
+        except KeyError:
+            raise ValueError(
+                f"Unknown hasher '{hasher}'. Valid: {', '.join(GOAUTH_HASHERS)}."
+            )
+
+    @staticmethod
+    def from_password(password, hasher="pbkdf2", **hash_opts):
+        return MosquittoGoauthHasher.get(hasher).from_password(password, **hash_opts)
+
+    @staticmethod
+    def from_string(s):
+        pw_hash = s.split(":")[-1]
+        if pw_hash.startswith("PBKDF2$"):
+            return MosquittoGoauthPassword.from_string(s)
+        if pw_hash.startswith("$2"):
+            return MosquittoGoauthBcryptPassword.from_string(s)
+        if pw_hash.startswith("argon2id$"):
+            return MosquittoGoauthArgon2Password.from_string(s)
+        raise ValueError("Could not detect the hasher of the input string.")
+
+
+def calibrate_pbkdf2(
+    target_ms=10,
+    connections=None,
+    hmac_hash="sha512",
+    keylen=None,
+    cpus=None,
+    cpu_share=0.5,
+    sample_iterations=10000,
+    samples=5,
+):
+    """
+    Benchmark PBKDF2 on this machine and recommend the number of iterations
+    that keeps a single password check below ``target_ms`` and, if
+    ``connections`` (authentications per second) is set, allows to handle
+    that many authentications using ``cpu_share`` of ``cpus`` cores.
+
+    The key length defaults to the digest size of ``hmac_hash``,
+    longer keys multiply the cost without improving security.
+    The iterations are rounded down to two significant digits to keep
+    the recommendation stable between runs.
+    """
+    digest_size = hashlib.new(hmac_hash).digest_size
+    keylen = keylen or digest_size
+    cpus = cpus or os.cpu_count() or 1
+
+    pw = MosquittoPasswordBase(
+        secrets.token_bytes(16),
+        "pbkdf2",
+        hmac_hash,
+        sample_iterations,
+        keylen,
+        password=secrets.token_bytes(16),
+    )
+    # warm up
+    pw._hash_pbkdf2()
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        pw._hash_pbkdf2()
+        timings.append(time.perf_counter() - start)
+    per_iteration = statistics.median(timings) / sample_iterations
+
+    iterations = target_ms / 1000 / per_iteration
+    limited_by = "latency"
+    if connections:
+        budget = cpus * cpu_share / connections
+        if budget / per_iteration < iterations:
+            iterations = budget / per_iteration
+            limited_by = "throughput"
+    iterations = _round_down(max(int(iterations), 1))
+
+    return {
+        "iterations": iterations,
+        "hmac_hash": hmac_hash,
+        "keylen": keylen,
+        "limited_by": limited_by,
+        "ms_per_auth": round(iterations * per_iteration * 1000, 3),
+        "auths_per_second": int(cpus * cpu_share / (iterations * per_iteration)),
+        "us_per_iteration": round(per_iteration * 1e6, 4),
+    }
+
+
+def _round_down(num, digits=2):
+    magnitude = 10 ** max(len(str(num)) - digits, 0)
+    return num // magnitude * magnitude
+
+
+def check_passwords(hasher, pairs, workers=None, processes=False, verify_cache=None):
+    """
+    Verify many (password, pw_hash) pairs on a worker pool.
+    ``hasher`` is the password class used to parse the hashes.
+    Pairs found in ``verify_cache`` are not recomputed, new successful
+    verifications are recorded there.
+    Returns a list of booleans in input order.
+    """
+    ret = [None] * len(pairs)
+    pending = []
+
+    for idx, (password, pw_hash) in enumerate(pairs):
+        if verify_cache is not None and verify_cache.lookup(pw_hash, password):
+            ret[idx] = True
+        else:
+            pending.append(idx)
+
+    results = _map_pool(
+        _check_password,
+        [(hasher, pairs[idx][1], pairs[idx][0]) for idx in pending],
+        workers=workers,
+        processes=processes,
+    )
+
+    for idx, res in zip(pending, results):
+        ret[idx] = res
+    if verify_cache is not None:
+        verify_cache.add(
+            [(pairs[idx][1], pairs[idx][0]) for idx, res in zip(pending, results) if res]
+        )
+    return ret
+
+
+def get_pw_hashes(hasher, passwords, workers=None, processes=False, **hash_opts):
+    """
+    Hash many passwords on a worker pool. ``hasher`` is the password class
+    and ``hash_opts`` are passed to its ``from_password`` method.
+    Returns a list of hash strings in input order.
+    """
+    return _map_pool(
+        _get_pw_hash,
+        [(hasher, password, hash_opts) for password in passwords],
+        workers=workers,
+        processes=processes,
+    )
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items without
+    consuming it as a whole.
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _check_password(args):
+    hasher, pw_hash, password = args
+    return hasher.from_string(pw_hash).check_password(password)
+
+
+def _get_pw_hash(args):
+    hasher, password, hash_opts = args
+    return hasher.from_password(password, **hash_opts).to_string()
+
+
+def _map_pool(func, items, workers=None, processes=False):
+    """
+    hashlib releases the GIL during PBKDF2, so threads scale with cores
+    as well. Processes are available for hashing functions that do not.
+    """
+    if not items:
+        return []
+    workers = min(workers or os.cpu_count() or 1, len(items))
+    if workers == 1:
+        return [func(item) for item in items]
+
+    if processes:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(items) // (workers * 4))
+            return list(pool.map(func, items, chunksize=chunksize))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, items))
+
+
+def verified_password_cache(context, opts):
+    """
+    Return the per-run instance of the verified password cache,
+    which lives in ``<cachedir>/mosquitto``. Returns None if it
+    was disabled by setting ``mosquitto.verify_cache: false``
+    in the minion configuration.
+    """
+    if not opts.get("mosquitto.verify_cache", True):
+        return None
+    if "mosquitto.verified_password_cache" not in context:
+        context["mosquitto.verified_password_cache"] = VerifiedPasswordCache(
+            Path(opts["cachedir"]) / "mosquitto",
+            max_size=opts.get("mosquitto.verify_cache_size", 65536),
+        )
+    return context["mosquitto.verified_password_cache"]
+
+
+class VerifiedPasswordCache:
+    """
+    Remembers successful password verifications, so unchanged passwords
+    do not have to be run through the key derivation function again.
+
+    Entries are HMACs of the stored hash string and the candidate password,
+    using a random key that is kept next to the cache. An entry thus
+    becomes unreachable as soon as the stored hash changes. Only successful
+    verifications are recorded. The cache file is append-only and compacted
+    to the most recently used entries once it grows beyond ``max_size``.
+    """
+
+    def __init__(self, cache_dir, max_size=65536):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self._key = None
+        self._entries = None
+
+    @property
+    def path(self):
+        return self.cache_dir / "verified_passwords"
+
+    @property
+    def key_path(self):
+        return self.cache_dir / "verified_passwords.key"
+
+    def check(self, pw_hash, password, verify):
+        """
+        Return True if the verification of ``password`` against ``pw_hash``
+        succeeded before. Otherwise, call ``verify`` and remember its
+        result if it is truthy.
+        """
+        if self.lookup(pw_hash, password):
+            return True
+        if not verify():
+            return False
+        self.add([(pw_hash, password)])
+        return True
+
+    def lookup(self, pw_hash, password):
+        """
+        Return True if the verification of ``password`` against ``pw_hash``
+        succeeded before.
+        """
+        self._load()
+        mac = self._mac(pw_hash, password)
+
+        if mac in self._entries:
+            # Keep track of recency for compaction
+            self._entries[mac] = self._entries.pop(mac)
+            return True
+        return False
+
+    def add(self, pairs):
+        """
+        Record successful verifications of (pw_hash, password) pairs.
+        """
+        self._load()
+        macs = [self._mac(pw_hash, password) for pw_hash, password in pairs]
+        if not macs:
+            return
+
+        self._entries.update(dict.fromkeys(macs))
+        if len(self._entries) > self.max_size:
+            self._compact()
+        else:
+            with open(self._open_private(self.path, os.O_APPEND), "a") as f:
+                f.write("".join(mac + "\n" for mac in macs))
+
+    def _mac(self, pw_hash, password):
+        password = password.encode() if isinstance(password, str) else password
+        return hmac.new(
+            self._key, pw_hash.encode() + b"\0" + password, "sha256"
+        ).hexdigest()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self.cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+
+        try:
+            fd = self._open_private(self.key_path, os.O_EXCL)
+        except FileExistsError:
+            self._key = self.key_path.read_bytes()
+        else:
+            self._key = secrets.token_bytes(32)
+            with open(fd, "wb") as f:
+                f.write(self._key)
+
+        try:
+            lines = self.path.read_text().splitlines()
+        except FileNotFoundError:
+            lines = []
+        self._entries = dict.fromkeys(line for line in lines if line)
+
+    def _compact(self):
+        keep = list(self._entries)[-(self.max_size * 3 // 4) :]
+        self._entries = dict.fromkeys(keep)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, "w") as f:
+            f.write("".join(mac + "\n" for mac in keep))
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def _open_private(path, flags):
+        return os.open(path, os.O_WRONLY | os.O_CREAT | flags, 0o600)
+
+
+def profiler(context, opts):
+    """
+    Return the per-run profile that records wall time and call counts per phase.
+    Recording is enabled by setting ``mosquitto.profile: true`` in the minion
+    configuration or by starting a profile explicitly with ``start_profile``.
+    Otherwise, returns a profile that discards everything.
+    """
+    if "mosquitto.profile" not in context:
+        if not opts.get("mosquitto.profile", False):
+            return NULL_PROFILE
+        start_profile(context)
+    return context["mosquitto.profile"]
+
+
+def start_profile(context):
+    """
+    Start recording a new profile for this run.
+    """
+    context["mosquitto.profile"] = Profile()
+    return context["mosquitto.profile"]
+
+
+class Profile:
+    """
+    Accumulates wall time and call counts per phase (e.g. read, verify, hash, write).
+    States take a ``snapshot`` before doing work and report the difference
+    ``since`` then, the totals are kept for the whole run.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name, calls=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, calls=calls)
+
+    def add(self, name, seconds=0.0, calls=1):
+        phase = self.phases.setdefault(name, {"calls": 0, "seconds": 0.0})
+        phase["calls"] += calls
+        phase["seconds"] += seconds
+
+    def snapshot(self):
+        return {name: dict(phase) for name, phase in self.phases.items()}
+
+    def since(self, snapshot):
+        ret = {}
+        for name, phase in self.phases.items():
+            prev = snapshot.get(name, {"calls": 0, "seconds": 0.0})
+            if phase["calls"] == prev["calls"]:
+                continue
+            ret[name] = {
+                "calls": phase["calls"] - prev["calls"],
+                "seconds": round(phase["seconds"] - prev["seconds"], 6),
+            }
+        return ret
+
+    def totals(self):
+        return self.since({})
+
+
+class _NullProfile(Profile):
+    @contextmanager
+    def phase(self, name, calls=1):
+        yield
+
+    def add(self, name, seconds=0.0, calls=1):
+        pass
+
+
+NULL_PROFILE = _NullProfile()
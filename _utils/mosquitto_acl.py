@@ -0,0 +1,602 @@
+"""
+Helper for evaluating Mosquitto ACLs without a running broker.
+
+The semantics follow Mosquitto's default ACL check:
+
+* Once an ACL is configured, read/write access is denied unless a rule
+  grants it. This includes ACLs without any rules.
+* Subscribing is always granted, access is checked on read/write.
+* Topic rules of the client's user (or the anonymous rules for clients
+  without a username) are checked first. Within a list, a matching ``deny``
+  rule takes precedence over allowing rules and denies access right away.
+* If no rule of the list matches the topic with the requested access,
+  pattern rules are checked. Clients whose username or client ID contain
+  ``+`` or ``#`` are denied. ``%u`` and ``%c`` are substituted by the
+  username and client ID, patterns containing ``%u`` are skipped for
+  anonymous clients.
+* Wildcards do not match topics starting with ``$``, those can only be
+  matched by rules starting with ``$`` as well.
+"""
+
+import re
+
+ACCESS_NONE = 0
+ACCESS_READ = 1
+ACCESS_WRITE = 2
+ACCESS_SUBSCRIBE = 4
+
+PERMISSIONS = {
+    "deny": ACCESS_NONE,
+    "read": ACCESS_READ,
+    "write": ACCESS_WRITE,
+    "readwrite": ACCESS_READ | ACCESS_WRITE,
+    # the template renders an empty permission, which Mosquitto reads as readwrite
+    "": ACCESS_READ | ACCESS_WRITE,
+}
+
+_SUBSTITUTION = re.compile("%[uc]")
+
+ACCESS = {
+    "read": ACCESS_READ,
+    "write": ACCESS_WRITE,
+    "readwrite": ACCESS_READ | ACCESS_WRITE,
+    "subscribe": ACCESS_SUBSCRIBE,
+}
+
+
+class TopicTrie:
+    """
+    Trie over topic levels. Each node holds the access values of the rules
+    ending there, wildcard levels (``+``, ``#``) are regular children that
+    are consulted during matching. Pattern levels containing ``%u``/``%c``
+    are kept separately since they need to be substituted per client.
+    """
+
+    __slots__ = ("children", "templates", "rules")
+
+    def __init__(self):
+        self.children = {}
+        self.templates = {}
+        self.rules = []
+
+    def __bool__(self):
+        return bool(self.rules or self.children or self.templates)
+
+    def insert(self, topic, access, pattern=False):
+        node = self
+        for level in topic.split("/"):
+            if pattern and ("%u" in level or "%c" in level):
+                node = node.templates.setdefault(level, TopicTrie())
+            else:
+                node = node.children.setdefault(level, TopicTrie())
+        node.rules.append(access)
+
+    def match(self, levels, username=None, clientid=None):
+        """
+        Return the access values of all rules matching the topic levels.
+        """
+        out = []
+        self._match(levels, 0, username, clientid, out)
+        return out
+
+    def _match(self, levels, i, username, clientid, out):
+        # wildcards never match the first level of $ topics
+        dollar = 0 == i and levels[0].startswith("$")
+
+        multi = self.children.get("#")
+        if multi is not None and not dollar:
+            # also matches the parent level
+            out.extend(multi.rules)
+        if i == len(levels):
+            out.extend(self.rules)
+            return
+
+        child = self.children.get(levels[i])
+        if child is not None:
+            child._match(levels, i + 1, username, clientid, out)
+
+        single = self.children.get("+")
+        if single is not None and not dollar:
+            single._match(levels, i + 1, username, clientid, out)
+
+        if dollar:
+            return
+        for template, child in self.templates.items():
+            value = substitute(template, username, clientid)
+            if value is None:
+                continue
+            parts = value.split("/")
+            if levels[i : i + len(parts)] == parts:
+                child._match(levels, i + len(parts), username, clientid, out)
+
+
+class AclIndex:
+    """
+    Compiled Mosquitto ACL.
+    """
+
+    def __init__(self):
+        self.anonymous = TopicTrie()
+        self.users = {}
+        self.patterns = TopicTrie()
+
+    def __bool__(self):
+        return bool(self.anonymous or self.patterns or self.users)
+
+    @classmethod
+    def from_data(cls, acl):
+        """
+        Compile an ACL from formula configuration, a mapping with the keys
+        ``anonymous`` and ``pattern`` (permission => list of topics)
+        and ``user`` (username => permission => list of topics).
+        """
+        index = cls()
+        acl = acl or {}
+
+        for perm, topics in (acl.get("anonymous") or {}).items():
+            for topic in topics or []:
+                index.add("topic", perm, topic)
+        for user, perms in (acl.get("user") or {}).items():
+            index.users.setdefault(str(user), TopicTrie())
+            for perm, topics in (perms or {}).items():
+                for topic in topics or []:
+                    index.add("topic", perm, topic, user=str(user))
+        for perm, topics in (acl.get("pattern") or {}).items():
+            for topic in topics or []:
+                index.add("pattern", perm, topic)
+        return index
+
+    @classmethod
+    def from_string(cls, contents):
+        """
+        Compile an ACL from the contents of a Mosquitto ACL file.
+        """
+        return cls.from_data(parse_acl(contents))
+
+    def add(self, kind, perm, topic, user=None):
+        if perm not in PERMISSIONS:
+            raise ValueError(f"Invalid ACL permission '{perm}' for topic {topic}.")
+        access = PERMISSIONS[perm]
+        if "pattern" == kind:
+            self.patterns.insert(topic, access, pattern=True)
+        elif user is None:
+            self.anonymous.insert(topic, access)
+        else:
+            self.users.setdefault(user, TopicTrie()).insert(topic, access)
+
+    def check(self, topic, access="read", username=None, clientid=None):
+        """
+        Check whether a client is granted access to a topic.
+        """
+        if access not in ACCESS:
+            raise ValueError(
+                f"Invalid access '{access}'. Valid: {', '.join(ACCESS)}."
+            )
+        if not topic or "+" in topic or "#" in topic:
+            raise ValueError(f"Invalid topic '{topic}'.")
+
+        access = ACCESS[access]
+        if ACCESS_SUBSCRIBE == access:
+            return True
+        if ACCESS_READ | ACCESS_WRITE == access:
+            return self._check(topic, ACCESS_READ, username, clientid) and self._check(
+                topic, ACCESS_WRITE, username, clientid
+            )
+        return self._check(topic, access, username, clientid)
+
+    def check_many(self, checks):
+        """
+        Check a list of (topic, access, username, clientid) tuples
+        and return a list of booleans.
+        """
+        # large batches usually contain many identical checks
+        cache = {}
+        ret = []
+        for check in checks:
+            if check not in cache:
+                cache[check] = self.check(*check)
+            ret.append(cache[check])
+        return ret
+
+    def _check(self, topic, access, username, clientid):
+        levels = topic.split("/")
+
+        if username is None:
+            rules = self.anonymous
+        else:
+            rules = self.users.get(username)
+
+        if rules:
+            # a matching deny rule denies access without consulting the patterns
+            granted = _evaluate(rules.match(levels), access)
+            if granted is not None:
+                return granted
+
+        if not self.patterns:
+            return False
+        if any(x is not None and ("+" in x or "#" in x) for x in (username, clientid)):
+            return False
+        return bool(_evaluate(self.patterns.match(levels, username, clientid), access))
+
+
+def parse_acl(contents):
+    """
+    Parse the contents of a Mosquitto ACL file into the format
+    of the formula's ``acl`` configuration.
+    """
+    acl = {"anonymous": {}, "user": {}, "pattern": {}}
+    user = None
+
+    for lineno, line in enumerate(contents.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        kind, _, rest = line.partition(" ")
+        rest = rest.strip()
+        if not rest:
+            raise ValueError(f"Invalid ACL line {lineno}: {line}")
+        if "user" == kind:
+            user = rest
+            acl["user"].setdefault(user, {})
+            continue
+        if kind not in ["topic", "pattern"]:
+            raise ValueError(f"Invalid ACL line {lineno}: {line}")
+
+        perm, _, topic = rest.partition(" ")
+        if perm in PERMISSIONS and topic.strip():
+            topic = topic.strip()
+        else:
+            perm, topic = "readwrite", rest
+
+        if "pattern" == kind:
+            rules = acl["pattern"]
+        elif user is None:
+            rules = acl["anonymous"]
+        else:
+            rules = acl["user"][user]
+        rules.setdefault(perm, []).append(topic)
+    return acl
+
+
+def render_acl(acl):
+    """
+    Render an ACL in the format of the formula's ``acl`` configuration
+    into the contents of a Mosquitto ACL file. The output is identical
+    to ``acl.j2``, but invalid permissions raise an error instead of
+    being skipped.
+    """
+    acl = acl or {}
+    out = [
+        "# This file is managed by Salt.\n# Manual changes might be overwritten.\n",
+        "\n## Anonymous permissions",
+    ]
+    _render_rules(out, "topic", acl.get("anonymous") or {}, "anonymous")
+
+    out.append("\n\n## User permissions")
+    for user, perms in _dictsort(acl.get("user") or {}):
+        out.append(f"\n\nuser {user}")
+        _render_rules(out, "topic", perms or {}, f"user {user}")
+
+    out.append("\n\n## Pattern matching")
+    _render_rules(out, "pattern", acl.get("pattern") or {}, "pattern")
+    out.append("\n")
+    return "".join(out)
+
+
+def _render_rules(out, kind, rules, scope):
+    for perm, topics in _dictsort(rules):
+        if perm not in PERMISSIONS:
+            raise ValueError(
+                f"Invalid ACL permission '{perm}' in {scope}. Valid: deny, read, write, readwrite."
+            )
+        for topic in topics:
+            out.append(f"\n{kind} {perm} {topic}")
+
+
+def _dictsort(data):
+    """
+    Sort like Jinja's ``dictsort`` filter (by key, case-insensitively).
+    """
+    return sorted(
+        data.items(), key=lambda x: x[0].lower() if isinstance(x[0], str) else x[0]
+    )
+
+
+def compile_acl(acl):
+    """
+    Normalize an ACL in the format of the formula's ``acl`` configuration
+    into the smallest equivalent one. Per list (anonymous, each user, patterns):
+
+    * Permissions of the same topic are merged (read + write => readwrite).
+    * Rules whose topics are covered by a wildcard rule of the same list with
+      at least the same permissions are dropped, as are allowing rules
+      covered by a deny rule and duplicate deny rules.
+    * Deny rules that neither overlap an allowing rule of their list nor
+      a pattern rule that grants access are dropped, since access to their
+      topics is denied anyway.
+
+    Mosquitto denies access as soon as a deny rule of the client's list
+    matches, without checking pattern rules. Deny rules of users and anonymous
+    clients that overlap allowing patterns thus restrict them and are always kept.
+
+    Returns a tuple of the compiled ACL and a report of dropped rules and
+    deny rules that are effective against pattern rules.
+    """
+    acl = acl or {}
+    compiled = {"anonymous": {}, "user": {}, "pattern": {}}
+    report = {"dropped": [], "effective": []}
+    patterns = acl.get("pattern") or {}
+
+    pattern_allows = _compile_list(
+        "pattern", patterns, compiled["pattern"], report["dropped"]
+    )
+    for scope, username, rules, target in [
+        ("anonymous", None, acl.get("anonymous") or {}, compiled["anonymous"])
+    ] + [
+        (
+            f"user {user}",
+            str(user),
+            perms or {},
+            compiled["user"].setdefault(str(user), {}),
+        )
+        for user, perms in (acl.get("user") or {}).items()
+    ]:
+
+        def blocked(deny, username=username):
+            return _blocked_patterns(deny, pattern_allows, username)
+
+        _compile_list(scope, rules, target, report["dropped"], blocked=blocked)
+        for deny in target.get("deny", []):
+            for topic, perm in blocked(deny):
+                report["effective"].append(
+                    {
+                        "scope": scope,
+                        "topic": deny,
+                        "perm": "deny",
+                        "reason": f"restricts pattern {perm} {topic}",
+                    }
+                )
+
+    compiled["user"] = {user: perms for user, perms in compiled["user"].items() if perms}
+
+    return compiled, report
+
+
+def _compile_list(scope, rules, target, dropped, blocked=None):
+    """
+    ``blocked`` returns the allowing patterns a deny rule overlaps,
+    those deny rules are always kept.
+    """
+    allows, denies = {}, set()
+
+    for perm, topics in rules.items():
+        if perm not in PERMISSIONS:
+            raise ValueError(
+                f"Invalid ACL permission '{perm}' in {scope}. Valid: deny, read, write, readwrite."
+            )
+        for topic in topics or []:
+            if ACCESS_NONE == PERMISSIONS[perm]:
+                denies.add(topic)
+            else:
+                allows[topic] = allows.get(topic, ACCESS_NONE) | PERMISSIONS[perm]
+
+    def drop(topic, access, reason):
+        dropped.append(
+            {"scope": scope, "topic": topic, "perm": _perm(access), "reason": reason}
+        )
+
+    for deny in sorted(denies):
+        other = _find_covering(deny, denies)
+        if other is not None:
+            denies.discard(deny)
+            drop(deny, ACCESS_NONE, f"covered by deny {other}")
+
+    for topic in sorted(allows):
+        deny = _find_covering(topic, denies)
+        if deny is not None:
+            drop(topic, allows.pop(topic), f"denied by {deny}")
+
+    wildcards = [x for x in allows if _is_wildcard(x)]
+    for topic in sorted(allows):
+        access = allows[topic]
+        candidates = [
+            x for x in wildcards if x in allows and allows[x] & access == access
+        ]
+        other = _find_covering(topic, candidates)
+        if other is not None:
+            allows.pop(topic)
+            drop(topic, access, f"covered by {_perm(allows[other])} {other}")
+
+    for deny in sorted(denies):
+        if any(intersects(deny, topic) for topic in allows):
+            continue
+        if blocked is not None and blocked(deny):
+            continue
+        denies.discard(deny)
+        drop(deny, ACCESS_NONE, "no rule grants access to its topics")
+
+    for topic, access in allows.items():
+        target.setdefault(_perm(access), []).append(topic)
+    if denies:
+        target["deny"] = sorted(denies)
+    for topics in target.values():
+        topics.sort()
+    return [(topic, _perm(access)) for topic, access in allows.items()]
+
+
+def _blocked_patterns(deny, pattern_allows, username):
+    """
+    Return the allowing patterns that apply to a user (or anonymous clients
+    if ``username`` is None) and overlap a deny rule of its list. ``%u``
+    is substituted, ``%c`` is assumed to be able to match anything.
+    """
+    ret = []
+    for topic, perm in pattern_allows:
+        substituted = topic
+        if "%u" in topic:
+            # %u patterns do not apply to anonymous clients
+            if username is None:
+                continue
+            substituted = topic.replace("%u", username)
+        if intersects(deny, substituted):
+            ret.append((topic, perm))
+    return ret
+
+
+def _find_covering(topic, others):
+    """
+    Return a different topic of ``others`` that covers ``topic``. Topics
+    that cover each other are equivalent, the lowest one of them is kept.
+    """
+    for other in others:
+        # different topics can only be covered by wildcards
+        if not _is_wildcard(other):
+            continue
+        if other == topic or not covers(other, topic):
+            continue
+        if covers(topic, other) and topic < other:
+            continue
+        return other
+    return None
+
+
+def _perm(access):
+    return {value: perm for perm, value in PERMISSIONS.items() if perm}[access]
+
+
+def split_sqlite_acl(acl):
+    """
+    Split an ACL in the format of the formula's ``acl`` configuration into rows
+    for the mosquitto-go-auth SQLite ``acls`` table and the rules that need to
+    stay in the ACL file. The table can only grant access to users, so anonymous
+    and pattern rules as well as users with deny rules are kept in the file.
+
+    go-auth checks access with a bitmask (read 1, write 2, subscribe 4).
+    Mosquitto grants subscribing to topics that can be read, so read rules
+    are stored with the subscribe bit set.
+
+    Returns a tuple of a mapping of (username, topic) to the access bitmask
+    and the remaining ACL.
+    """
+    acl = acl or {}
+    rows = {}
+    remaining = {
+        "anonymous": acl.get("anonymous") or {},
+        "user": {},
+        "pattern": acl.get("pattern") or {},
+    }
+
+    for user, perms in (acl.get("user") or {}).items():
+        perms = perms or {}
+        for perm in perms:
+            if perm not in PERMISSIONS:
+                raise ValueError(
+                    f"Invalid ACL permission '{perm}' in user {user}. Valid: deny, read, write, readwrite."
+                )
+        if not any(perms.values()) or perms.get("deny"):
+            remaining["user"][str(user)] = perms
+            continue
+        for perm, topics in perms.items():
+            access = PERMISSIONS[perm]
+            if access & ACCESS_READ:
+                access |= ACCESS_SUBSCRIBE
+            for topic in topics or []:
+                key = (str(user), topic)
+                rows[key] = rows.get(key, ACCESS_NONE) | access
+
+    return rows, remaining
+
+
+def count_rules(acl):
+    """
+    Count the topic rules of an ACL in the format of the formula's ``acl`` configuration.
+    """
+    lists = [acl.get("anonymous") or {}, acl.get("pattern") or {}]
+    lists += [perms or {} for perms in (acl.get("user") or {}).values()]
+    return sum(len(topics or []) for rules in lists for topics in rules.values())
+
+
+def _target(compiled, scope):
+    if scope in ["anonymous", "pattern"]:
+        return compiled[scope]
+    return compiled["user"].setdefault(scope[len("user ") :], {})
+
+
+def covers(outer, inner):
+    """
+    Check whether every topic matched by the topic filter ``inner``
+    is matched by ``outer`` as well. Pattern levels are only
+    considered to be covered by identical levels or ``#``.
+    """
+    outer, inner = outer.split("/"), inner.split("/")
+
+    for n, level in enumerate(outer):
+        if "#" == level:
+            # also matches the parent level, but not $ topics
+            return not (0 == n and inner[0].startswith("$"))
+        if n == len(inner) or "#" == inner[n]:
+            return False
+        if "+" == level:
+            if _is_template(inner[n]) or (0 == n and inner[n].startswith("$")):
+                return False
+            continue
+        if level != inner[n]:
+            return False
+    return len(outer) == len(inner)
+
+
+def intersects(first, second):
+    """
+    Check whether there is a topic that is matched by both topic filters.
+    Pattern levels are assumed to be able to match anything.
+    """
+    first, second = first.split("/"), second.split("/")
+
+    for n in range(max(len(first), len(second))):
+        if n == len(first) or n == len(second):
+            # "#" also matches the parent level
+            rest = first if n == len(second) else second
+            return "#" == rest[n]
+        this, that = first[n], second[n]
+        if 0 == n and (
+            (this in ["+", "#"] and that.startswith("$"))
+            or (that in ["+", "#"] and this.startswith("$"))
+        ):
+            return False
+        if "#" in [this, that] or _is_template(this) or _is_template(that):
+            return True
+        if "+" not in [this, that] and this != that:
+            return False
+    return True
+
+
+def _is_wildcard(topic):
+    return "+" in topic or "#" in topic
+
+
+def _is_template(level):
+    return "%u" in level or "%c" in level
+
+
+def _evaluate(matches, access):
+    """
+    Deny rules are evaluated before allowing ones. Returns None
+    if no rule matches the requested access.
+    """
+    if ACCESS_NONE in matches:
+        return False
+    if any(match & access for match in matches):
+        return True
+    return None
+
+
+def substitute(template, username, clientid):
+    """
+    Substitute ``%u`` and ``%c`` in a pattern. Returns None if the pattern
+    references a value the client does not have (e.g. anonymous clients and ``%u``).
+    """
+    values = {"%u": username, "%c": clientid}
+    if any(values[var] is None for var in _SUBSTITUTION.findall(template)):
+        return None
+    return _SUBSTITUTION.sub(lambda match: values[match.group(0)], template)
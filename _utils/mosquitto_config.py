@@ -0,0 +1,186 @@
+"""
+Helper for Mosquitto configuration files.
+"""
+
+
+def render_config(config):
+    """
+    Render a mapping of configuration values into the contents of
+    ``mosquitto.conf``. The output is identical to ``mosquitto.conf.j2``:
+    Global options are rendered first, followed by ``auth_opt_*``
+    options and listener blocks. Lists result in multiple lines with the
+    same key, unset (None) values are skipped.
+    """
+    out = []
+
+    for var, val in config.items():
+        if val is None or var.startswith("listener") or var.startswith("auth_opt"):
+            continue
+        _render(out, var, val)
+
+    out.append("\n\n")
+    for var, val in config.items():
+        if val is None or not var.startswith("auth_opt"):
+            continue
+        _render(out, var, val)
+
+    out.append("\n\n")
+    for var, val in config.items():
+        if val is None or not var.startswith("listener"):
+            continue
+        out.append(f"\n{var}")
+        for k, v in val.items():
+            _render(out, k, v)
+
+    out.append("\n")
+    return "".join(out)
+
+
+def _render(out, key, val):
+    # 0/1 compare equal to booleans, the template treats them the same way
+    if val in [True, False]:
+        out.append(f"\n{key} {str(val).lower()}")
+    elif isinstance(val, list):
+        for item in val:
+            _render(out, key, item)
+    else:
+        out.append(f"\n{key} {val}")
+
+
+# Options that are reread when the broker receives SIGHUP (see mosquitto.conf(5)).
+# Changes to all other options require a restart.
+RELOADABLE = {
+    "acl_file",
+    "allow_anonymous",
+    "allow_duplicate_messages",
+    "allow_zero_length_clientid",
+    "auto_id_prefix",
+    "autosave_interval",
+    "autosave_on_changes",
+    "check_retain_source",
+    "clientid_prefixes",
+    "connection_messages",
+    "log_dest",
+    "log_facility",
+    "log_timestamp",
+    "log_timestamp_format",
+    "log_type",
+    "max_inflight_bytes",
+    "max_inflight_messages",
+    "max_keepalive",
+    "max_packet_size",
+    "max_queued_bytes",
+    "max_queued_messages",
+    "memory_limit",
+    "message_size_limit",
+    "password_file",
+    "persistent_client_expiration",
+    "psk_file",
+    "queue_qos0_messages",
+    "retain_available",
+    "set_tcp_nodelay",
+    "sys_interval",
+    "upgrade_outgoing_qos",
+}
+
+# Listener options that are reread when the broker receives SIGHUP
+RELOADABLE_LISTENER = {
+    "acl_file",
+    "allow_anonymous",
+    "allow_zero_length_clientid",
+    "auto_id_prefix",
+    "password_file",
+    "psk_file",
+}
+
+
+def parse_config(contents):
+    """
+    Parse the contents of ``mosquitto.conf`` into a normalized model,
+    a mapping with the keys ``global``, ``auth_opt`` (plugin options)
+    and ``listeners`` (listener => options). Options are mappings of keys
+    to sorted lists of values, so the order of lines does not matter.
+    Options following a ``listener`` line are attributed to that listener.
+    """
+    model = {"global": {}, "auth_opt": {}, "listeners": {}}
+    listener = None
+
+    for lineno, line in enumerate(contents.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        key, _, val = line.partition(" ")
+        val = " ".join(val.split())
+        if "listener" == key:
+            if not val:
+                raise ValueError(f"Invalid configuration line {lineno}: {line}")
+            listener = val
+            model["listeners"].setdefault(listener, {})
+            continue
+
+        if key.startswith("auth_opt_") or key.startswith("plugin_opt_"):
+            scope = model["auth_opt"]
+        elif listener is not None:
+            scope = model["listeners"][listener]
+        else:
+            scope = model["global"]
+        scope.setdefault(key, []).append(val)
+
+    for scope in [model["global"], model["auth_opt"], *model["listeners"].values()]:
+        for values in scope.values():
+            values.sort()
+    return model
+
+
+def diff_config(old, new):
+    """
+    Compare two models returned by ``parse_config``. Returns a list of changes
+    (mappings with ``scope``, ``key``, ``old``, ``new`` and ``action``) and the
+    action that is necessary to apply all of them: ``none``, ``reload`` or ``restart``.
+    """
+    changes = []
+
+    def compare(scope, old_opts, new_opts, reloadable):
+        for key in sorted(set(old_opts).union(new_opts)):
+            old_val, new_val = old_opts.get(key), new_opts.get(key)
+            if old_val == new_val:
+                continue
+            changes.append(
+                {
+                    "scope": scope,
+                    "key": key,
+                    "old": old_val,
+                    "new": new_val,
+                    "action": "reload" if key in reloadable else "restart",
+                }
+            )
+
+    compare("global", old.get("global", {}), new.get("global", {}), RELOADABLE)
+    compare("auth_opt", old.get("auth_opt", {}), new.get("auth_opt", {}), set())
+
+    old_listeners, new_listeners = old.get("listeners", {}), new.get("listeners", {})
+    for listener in sorted(set(old_listeners).union(new_listeners)):
+        if listener not in old_listeners or listener not in new_listeners:
+            changes.append(
+                {
+                    "scope": f"listener {listener}",
+                    "key": None,
+                    "old": old_listeners.get(listener),
+                    "new": new_listeners.get(listener),
+                    "action": "restart",
+                }
+            )
+            continue
+        compare(
+            f"listener {listener}",
+            old_listeners[listener],
+            new_listeners[listener],
+            RELOADABLE_LISTENER,
+        )
+
+    if any("restart" == change["action"] for change in changes):
+        return changes, "restart"
+    if changes:
+        return changes, "reload"
+    return changes, "none"
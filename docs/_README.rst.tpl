@@ -77,3 +77,11 @@ There is a script that semi-autodocuments available states: ``bin/slsdoc``.
 If a ``.sls`` file begins with a Jinja comment, it will dump that into the docs. It can be configured differently depending on the formula. See the script source code for details currently.
 
 This means if you feel a state should be documented, make sure to write a comment explaining it.
+
+Benchmarks
+^^^^^^^^^^
+``bin/benchmark`` measures the hot paths of the custom modules (password file and SQLite backends,
+password hashing, user states) with synthetic users and writes a JSON report. Compare it with
+the report of a previous release on the same machine to detect regressions. ::
+
+  $ bin/benchmark --output new.json --compare old.json
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The custom modules are not packaged, make the utils importable like Salt does
+sys.path.insert(0, str(Path(__file__).parent.parent / "_utils"))
@@ -0,0 +1,41 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+BENCHMARK = Path(__file__).parent.parent.parent / "bin" / "benchmark"
+
+
+def _run(*args):
+    return subprocess.run(
+        [sys.executable, str(BENCHMARK), "--sizes", "10", "--repeat", "1", *args],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+
+
+def test_benchmark_smoke(tmp_path):
+    """
+    Run the smallest size, so the script does not silently stop working
+    when the modules change.
+    """
+    report = tmp_path / "report.json"
+    res = _run("--output", str(report))
+    assert res.returncode == 0, res.stderr
+    data = json.loads(report.read_text())
+    assert data["meta"]["python"]
+    for backend in ("file", "sqlite"):
+        assert any(name.startswith(f"{backend}/10/") for name in data["benchmarks"])
+    for result in data["benchmarks"].values():
+        assert result["median"] >= 0
+
+    res = _run(
+        "--output",
+        str(tmp_path / "new.json"),
+        "--compare",
+        str(report),
+        "--threshold",
+        "1000",
+    )
+    assert res.returncode == 0, res.stderr
@@ -0,0 +1,82 @@
+import pytest
+
+import mosquitto_acl
+
+
+@pytest.fixture
+def index():
+    return mosquitto_acl.AclIndex.from_data(
+        {
+            "anonymous": {"read": ["public/#"], "deny": ["public/private"]},
+            "user": {"bob": {"deny": ["secret/#"], "read": ["#"]}},
+            "pattern": {"read": ["secret/%u", "devices/%c/#"]},
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "topic,username,clientid,expected",
+    [
+        # a matching user deny is final, patterns are not consulted
+        ("secret/bob", "bob", None, False),
+        # a matching anonymous deny is final as well
+        ("public/private", None, None, False),
+        # without a matching rule in the user's list, patterns apply
+        ("secret/alice", "alice", None, True),
+        ("secret/bob", "alice", None, False),
+        ("devices/phone/state", "bob", "phone", True),
+        ("devices/phone/state", "alice", "phone", True),
+        ("public/news", None, None, True),
+    ],
+)
+def test_deny_vs_pattern(index, topic, username, clientid, expected):
+    assert index.check(topic, "read", username=username, clientid=clientid) is expected
+
+
+def test_pattern_applies_when_user_rule_does_not_match_access():
+    index = mosquitto_acl.AclIndex.from_data(
+        {
+            "user": {"bob": {"read": ["secret/bob"]}},
+            "pattern": {"readwrite": ["secret/%u"]},
+        }
+    )
+    assert index.check("secret/bob", "write", username="bob") is True
+
+
+@pytest.mark.parametrize(
+    "topic,expected",
+    [
+        # wildcards do not match $ topics
+        ("$SYS/broker/uptime", False),
+        ("$share/group/x", False),
+        # rules starting with $ do
+        ("$CONTROL/dynamic-security/v1", True),
+        ("regular/topic", True),
+    ],
+)
+def test_dollar_topics(topic, expected):
+    index = mosquitto_acl.AclIndex.from_data(
+        {
+            "user": {"bob": {"read": ["#", "+/broker/+"]}},
+            "pattern": {"read": ["+/%u/#"]},
+        }
+    )
+    index.add("topic", "read", "$CONTROL/#", user="bob")
+    assert index.check(topic, "read", username="bob") is expected
+
+
+def test_dollar_topic_deny():
+    index = mosquitto_acl.AclIndex.from_data(
+        {"user": {"bob": {"read": ["$SYS/#"], "deny": ["$SYS/broker/clients/#"]}}}
+    )
+    assert index.check("$SYS/broker/uptime", "read", username="bob") is True
+    assert index.check("$SYS/broker/clients/total", "read", username="bob") is False
+
+
+@pytest.mark.parametrize("contents", ["", "user bob\n"])
+def test_acl_without_rules_denies(contents):
+    index = mosquitto_acl.AclIndex.from_string(contents)
+    for username in (None, "bob"):
+        assert index.check("foo/bar", "read", username=username) is False
+        assert index.check("foo/bar", "write", username=username) is False
+        assert index.check("foo/bar", "subscribe", username=username) is True
@@ -0,0 +1,82 @@
+import itertools
+
+import pytest
+
+import mosquitto_acl
+
+TOPICS = [
+    "secret/bob",
+    "secret/alice",
+    "secret/bob/x",
+    "a/b",
+    "a/c",
+    "devices/phone/state",
+    "$SYS/broker/uptime",
+]
+
+
+def _assert_equivalent(acl, compiled, users=("bob", "alice", None)):
+    before = mosquitto_acl.AclIndex.from_data(acl)
+    after = mosquitto_acl.AclIndex.from_data(compiled)
+    for topic, access, username in itertools.product(
+        TOPICS, ["read", "write"], users
+    ):
+        assert before.check(topic, access, username, "phone") == after.check(
+            topic, access, username, "phone"
+        ), (topic, access, username)
+
+
+@pytest.mark.parametrize(
+    "acl",
+    [
+        {
+            "user": {"bob": {"deny": ["secret/bob"], "read": ["a/#"]}},
+            "pattern": {"read": ["secret/%u"]},
+        },
+        {
+            "anonymous": {"deny": ["secret/+"], "read": ["a/b"]},
+            "pattern": {"read": ["secret/%c"]},
+        },
+        {
+            "user": {"bob": {"deny": ["devices/+/state"], "read": ["a/b"]}},
+            "pattern": {"readwrite": ["devices/%c/#"]},
+        },
+    ],
+)
+def test_deny_restricting_patterns_is_kept(acl):
+    compiled, report = mosquitto_acl.compile_acl(acl)
+    scope = "anonymous" if "anonymous" in acl else "user bob"
+    deny = (acl.get("anonymous") or acl["user"]["bob"])["deny"]
+    kept = (compiled["anonymous"] if "anonymous" in acl else compiled["user"]["bob"])
+    assert kept["deny"] == deny
+    assert [x["topic"] for x in report["effective"] if x["scope"] == scope] == deny
+    assert not [x for x in report["dropped"] if "deny" == x["perm"]]
+    _assert_equivalent(acl, compiled)
+
+
+def test_deny_without_overlap_is_dropped():
+    acl = {
+        "user": {"bob": {"deny": ["secret/alice"], "read": ["a/#"]}},
+        "pattern": {"read": ["secret/%u"]},
+    }
+    compiled, report = mosquitto_acl.compile_acl(acl)
+    assert "deny" not in compiled["user"]["bob"]
+    assert not report["effective"]
+    _assert_equivalent(acl, compiled, users=("bob",))
+
+
+def test_redundant_rules_are_dropped():
+    acl = {
+        "user": {"bob": {"read": ["a/#", "a/b"], "write": ["a/b"], "readwrite": ["a/c"]}}
+    }
+    compiled, _ = mosquitto_acl.compile_acl(acl)
+    assert compiled["user"]["bob"] == {"read": ["a/#"], "readwrite": ["a/b", "a/c"]}
+    _assert_equivalent(acl, compiled)
+
+
+def test_deny_only_acl_compiles_to_empty():
+    acl = {"anonymous": {"deny": ["a/#"]}, "user": {"bob": {"deny": ["secret/#"]}}}
+    compiled, report = mosquitto_acl.compile_acl(acl)
+    assert compiled == {"anonymous": {}, "user": {}, "pattern": {}}
+    assert len(report["dropped"]) == 2
+    _assert_equivalent(acl, compiled)
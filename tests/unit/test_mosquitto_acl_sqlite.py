@@ -0,0 +1,130 @@
+import importlib.util
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+import mosquitto_acl
+
+REPO = Path(__file__).parent.parent.parent
+
+
+def test_split_bitmask():
+    rows, remaining = mosquitto_acl.split_sqlite_acl(
+        {
+            "user": {
+                "alice": {
+                    "read": ["a/r"],
+                    "write": ["a/w"],
+                    "readwrite": ["a/rw"],
+                    "": ["a/empty"],
+                }
+            }
+        }
+    )
+    # read rules get the subscribe bit (read 1, write 2, subscribe 4)
+    assert rows == {
+        ("alice", "a/r"): 5,
+        ("alice", "a/w"): 2,
+        ("alice", "a/rw"): 7,
+        ("alice", "a/empty"): 7,
+    }
+    assert remaining == {"anonymous": {}, "user": {}, "pattern": {}}
+
+
+def test_split_merges_permissions_of_a_topic():
+    rows, _ = mosquitto_acl.split_sqlite_acl(
+        {"user": {"alice": {"read": ["a/b"], "write": ["a/b"]}}}
+    )
+    assert rows == {("alice", "a/b"): 7}
+
+
+def test_split_keeps_file_rules():
+    acl = {
+        "anonymous": {"read": ["public/#"]},
+        "pattern": {"readwrite": ["devices/%c/#"]},
+        "user": {
+            "alice": {"read": ["a/#"]},
+            "bob": {"read": ["b/#"], "deny": ["b/secret"]},
+            "carol": {},
+        },
+    }
+    rows, remaining = mosquitto_acl.split_sqlite_acl(acl)
+    assert rows == {("alice", "a/#"): 5}
+    # the table cannot deny access or hold anonymous/pattern rules
+    assert remaining == {
+        "anonymous": acl["anonymous"],
+        "user": {"bob": acl["user"]["bob"], "carol": {}},
+        "pattern": acl["pattern"],
+    }
+
+
+def test_split_invalid_permission():
+    with pytest.raises(ValueError, match="Invalid ACL permission"):
+        mosquitto_acl.split_sqlite_acl({"user": {"alice": {"subscribe": ["a"]}}})
+
+
+@pytest.fixture
+def goauth():
+    spec = importlib.util.spec_from_file_location(
+        "mosquitto_goauth_mod", REPO / "_modules" / "mosquitto_goauth.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    module.__context__ = {}
+    module.__opts__ = {}
+    module.__salt__ = {}
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def auth_db(tmp_path, goauth):
+    db = tmp_path / "auth.db"
+    con = sqlite3.connect(db)
+    con.execute(
+        "create table users (id INTEGER PRIMARY KEY, username varchar(100) not null, "
+        "password_hash varchar(200) not null, is_admin integer not null)"
+    )
+    con.execute(
+        "create table acls (id INTEGER PRIMARY KEY, username varchar(100) not null, "
+        "topic varchar(255) not null, rw integer not null)"
+    )
+    con.executemany(
+        "insert into acls (username, topic, rw) values (?, ?, ?)",
+        [("alice", "a/#", 5), ("alice", "a/cmd", 2), ("old", "x", 1)],
+    )
+    con.commit()
+    con.close()
+    goauth.migrate_schema(str(db), wal=False)
+    return db
+
+
+def _rows(db):
+    con = sqlite3.connect(db)
+    try:
+        return set(con.execute("select username, topic, rw from acls"))
+    finally:
+        con.close()
+
+
+def test_sync_acls(goauth, auth_db):
+    acl = {
+        "anonymous": {"read": ["public/#"]},
+        "user": {
+            "alice": {"read": ["a/#"], "readwrite": ["a/cmd"]},
+            "bob": {"write": ["b/#"]},
+            "carol": {"deny": ["c/#"], "read": ["#"]},
+        },
+    }
+    expected = {
+        "added": {"bob": ["b/#"]},
+        "updated": {"alice": ["a/cmd"]},
+        "removed": {"old": ["x"]},
+    }
+    before = _rows(auth_db)
+    assert goauth.sync_acls(str(auth_db), acl=acl, test=True) == expected
+    assert _rows(auth_db) == before
+
+    assert goauth.sync_acls(str(auth_db), acl=acl) == expected
+    assert _rows(auth_db) == {("alice", "a/#", 5), ("alice", "a/cmd", 7), ("bob", "b/#", 2)}
+    assert goauth.sync_acls(str(auth_db), acl=acl) == {}
@@ -0,0 +1,42 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def mod():
+    path = Path(__file__).parent.parent.parent / "_modules" / "mosquitto.py"
+    spec = importlib.util.spec_from_file_location("mosquitto_mod", path)
+    module = importlib.util.module_from_spec(spec)
+    module.__context__ = {}
+    module.__opts__ = {"saltenv": "base", "pillarenv": None}
+    module.__grains__ = {"id": "minion"}
+    module.__pillar__ = {"mosquitto": {"listeners": {1883: {}, "ws": {}}}}
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_mixed_key_types_are_cached(mod):
+    assert mod.cache_mapdata("mosquitto", {"foo": "bar"}) is True
+    assert mod.get_cached_mapdata("mosquitto") == {"foo": "bar"}
+
+
+def test_int_and_str_keys_are_distinct(mod):
+    first = mod._mapdata_fingerprint("mosquitto")
+    mod.__pillar__["mosquitto"]["listeners"] = {"1883": {}, "ws": {}}
+    assert mod._mapdata_fingerprint("mosquitto") != first
+
+
+def test_pillar_change_invalidates(mod):
+    mod.cache_mapdata("mosquitto", {"foo": "bar"})
+    mod.__pillar__["mosquitto"]["listeners"][8883] = {}
+    assert mod.get_cached_mapdata("mosquitto") is None
+
+
+def test_unserializable_pillar_disables_cache(mod):
+    loop = {}
+    loop["self"] = loop
+    mod.__pillar__["loop"] = loop
+    assert mod.cache_mapdata("mosquitto", {"foo": "bar"}) is False
+    assert mod.get_cached_mapdata("mosquitto") is None
@@ -0,0 +1,23 @@
+import pytest
+
+import mosquitto
+
+
+@pytest.mark.parametrize("contents", ["a:x\nc:y\n\n", "a:x\nc:y\r\n\r\n", "a:x\nc:y"])
+def test_append_keeps_sort_order_tracking(tmp_path, contents):
+    pw_file = tmp_path / "passwd"
+    pw_file.write_text(contents)
+    # parsing marks the file as sorted
+    mosquitto.read_pw_file(str(pw_file))
+    mosquitto.append_pw_file(str(pw_file), "b", "z")
+    assert list(mosquitto.iter_pw_file(str(pw_file), prefix="b")) == ["b"]
+    assert mosquitto.read_pw_entry(str(pw_file), "b") == "z"
+
+
+def test_append_after_last_user_stays_sorted(tmp_path):
+    pw_file = tmp_path / "passwd"
+    pw_file.write_text("a:x\nc:y\n\n")
+    mosquitto.read_pw_file(str(pw_file))
+    mosquitto.append_pw_file(str(pw_file), "d", "z")
+    assert list(mosquitto.iter_pw_file(str(pw_file), prefix="d")) == ["d"]
+    assert list(mosquitto.iter_pw_file(str(pw_file))) == ["a", "c", "d"]
@@ -0,0 +1,108 @@
+import importlib.util
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from salt.exceptions import CommandExecutionError
+
+REPO = Path(__file__).parent.parent.parent
+
+# Stand-in for the broker that records the signals it receives
+STAND_IN = """
+import signal, sys, time
+def record(signum, frame):
+    with open(sys.argv[1], "a") as f:
+        f.write(signal.Signals(signum).name + "\\n")
+signal.signal(signal.SIGHUP, record)
+print("ready", flush=True)
+while True:
+    time.sleep(0.1)
+"""
+
+
+def _load(kind, **dunders):
+    spec = importlib.util.spec_from_file_location(
+        f"mosquitto_{kind}", REPO / f"_{kind}" / "mosquitto.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    for name, val in dunders.items():
+        setattr(module, f"__{name}__", val)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def mod():
+    return _load("modules", context={}, opts={}, salt={})
+
+
+@pytest.fixture
+def states(mod):
+    return _load(
+        "states", context={}, opts={"test": False}, salt={"mosquitto.reload": mod.reload}
+    )
+
+
+@pytest.fixture
+def broker(tmp_path):
+    received = tmp_path / "signals"
+    received.touch()
+    proc = subprocess.Popen(
+        [sys.executable, "-c", STAND_IN, str(received)], stdout=subprocess.PIPE, text=True
+    )
+    assert proc.stdout.readline().strip() == "ready"
+    yield proc, received
+    proc.kill()
+    proc.wait()
+
+
+def _signals(received, count=1, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        signals = received.read_text().split()
+        if len(signals) >= count:
+            return signals
+        time.sleep(0.05)
+    return received.read_text().split()
+
+
+def test_reload_pid(mod, broker):
+    proc, received = broker
+    assert mod.reload(pid=proc.pid) is True
+    assert _signals(received) == ["SIGHUP"]
+    assert proc.poll() is None
+
+
+def test_reload_pidfile(mod, broker, tmp_path):
+    proc, received = broker
+    pidfile = tmp_path / "mosquitto.pid"
+    pidfile.write_text(f"{proc.pid}\n")
+    assert mod.reload(pidfile=str(pidfile)) is True
+    assert _signals(received) == ["SIGHUP"]
+
+
+def test_reloaded_mod_watch(states, broker):
+    proc, received = broker
+    ret = states.mod_watch("mosquitto", sfun="reloaded", pid=proc.pid)
+    assert ret["result"] is True
+    assert ret["changes"] == {"reloaded": "mosquitto"}
+    assert _signals(received) == ["SIGHUP"]
+
+
+@pytest.fixture
+def missing_pid():
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+def test_reload_missing_process(mod, states, missing_pid, tmp_path):
+    with pytest.raises(CommandExecutionError, match="does not exist"):
+        mod.reload(pid=missing_pid)
+    with pytest.raises(CommandExecutionError, match="Could not read PID"):
+        mod.reload(pidfile=str(tmp_path / "missing.pid"))
+    ret = states.mod_watch("mosquitto", sfun="reloaded", pid=missing_pid)
+    assert ret["result"] is False
+    assert not ret["changes"]
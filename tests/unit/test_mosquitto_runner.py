@@ -0,0 +1,100 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+import salt.config
+import salt.utils.yaml
+
+import mosquitto
+
+REPO = Path(__file__).parent.parent.parent
+
+
+@pytest.fixture
+def runner(tmp_path):
+    spec = importlib.util.spec_from_file_location(
+        "mosquitto_runner", REPO / "_runners" / "mosquitto.py"
+    )
+    module = importlib.util.module_from_spec(spec)
+    opts = salt.config.master_config(None)
+    opts.update(
+        {
+            "cachedir": str(tmp_path / "cache"),
+            "extension_modules": str(tmp_path / "extmods"),
+            "file_roots": {"base": [str(REPO)]},
+            "fileserver_backend": ["roots"],
+            "cache": "localfs",
+        }
+    )
+    module.__opts__ = opts
+    module.__salt__ = {}
+    spec.loader.exec_module(module)
+    return module
+
+
+def _hash_pillar(runner, tmp_path, pillars, grains=None):
+    runner.__salt__.update(
+        {
+            "cache.grains": lambda tgt, tgt_type: {
+                minion: (grains or {}).get(minion, {}) for minion in pillars
+            },
+            "pillar.show_pillar": lambda minion: pillars[minion],
+        }
+    )
+    output = tmp_path / "hashes.sls"
+    runner.hash_pillar("*", str(output))
+    return salt.utils.yaml.safe_load(output.read_text())[runner.DEFAULT_PILLAR_KEY]
+
+
+def test_goauth_uses_variant_default_config(runner, tmp_path):
+    pillars = {
+        "broker": {
+            "mosquitto": {
+                "container_variant": "mosquitto_go_auth",
+                "users": {"present": {"alice": {"password": "hunter1"}}},
+            }
+        }
+    }
+    pw_hash = mosquitto.MosquittoGoauthHasher.from_string(
+        _hash_pillar(runner, tmp_path, pillars)["alice"]
+    )
+    assert pw_hash.params["keylen"] == 64
+    assert pw_hash.params["iterations"] == 100000
+    assert pw_hash.check_password("hunter1")
+
+
+def test_goauth_pillar_config_overrides_defaults(runner, tmp_path):
+    pillars = {
+        "broker": {
+            "mosquitto": {
+                "container_variant": "mosquitto_go_auth",
+                "config": {"auth_opt_hasher_iterations": 1000},
+                "tuning": {"hash_calibration": True},
+                "users": {"present": {"alice": {"password": "hunter1"}}},
+            }
+        }
+    }
+    grains = {
+        "broker": {
+            "mosquitto_hash_calibration": {
+                "iterations": 5000,
+                "hmac_hash": "sha256",
+                "keylen": 32,
+            }
+        }
+    }
+    pw_hash = mosquitto.MosquittoGoauthHasher.from_string(
+        _hash_pillar(runner, tmp_path, pillars, grains)["alice"]
+    )
+    # configured settings win over calibration, calibration over defaults
+    assert pw_hash.params["iterations"] == 1000
+    assert pw_hash.params["hmac_hash"] == "sha256"
+    assert pw_hash.params["keylen"] == 32
+
+
+def test_hashes_are_salted_per_user(runner):
+    hashes = runner.hash_passwords({"alice": "hunter1", "bob": "hunter1"})
+    assert hashes["alice"] != hashes["bob"]
+    # the cache still returns the same hash for the same user
+    assert runner.hash_passwords({"alice": "hunter1"})["alice"] == hashes["alice"]
+    assert runner.hash_passwords({"alice": "hunter2"})["alice"] != hashes["alice"]